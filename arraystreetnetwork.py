@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# arraystreetnetwork.py
+# Copyright 2012 Julian Fietkau <http://www.julian-fietkau.de/>,
+#                Joachim Nitschke
+#
+# This file is part of Streets4MPI.
+#
+# Streets4MPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Streets4MPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from shortestpaths import create_shortest_path_engine
+from utils import assign_array, as_numpy
+
+# This class represents a street network using flat typed arrays instead of a
+# pygraph object. Nodes are remapped to dense indices, streets are stored
+# column-wise by street index and the adjacency is kept in compressed sparse
+# row form. It offers the same interface as StreetNetwork.
+class ArrayStreetNetwork(object):
+
+    def __init__(self):
+        self.bounds = None
+        # give every street a sequential index (used for perfomance optimization)
+        self.street_index = 0
+
+        # dense node index for every OSM node id and back
+        self.node_indices = dict()
+        self.node_ids = array("l")
+        self.node_longitudes = array("d")
+        self.node_latitudes = array("d")
+
+        # street attributes, indexed by street index
+        self.street_origins = array("i")
+        self.street_destinations = array("i")
+        self.street_lengths = array("d")
+        self.street_max_speeds = array("d")
+        self.street_driving_times = array("d")
+        # coordinates of the points between the end nodes of streets that
+        # replace a chain of streets (see simplification.py), from the lower
+        # node id to the higher one: the points of street i are found at
+        # positions geometry_offsets[i] to geometry_offsets[i+1]-1
+        self.geometry_offsets = array("i", [0])
+        self.geometry_longitudes = array("d")
+        self.geometry_latitudes = array("d")
+        # incremented on every change of the driving times so that shortest
+        # path engines can tell whether their cached weights are outdated
+        self.driving_time_version = 0
+        # highest speed limit in the network, computed on demand
+        self._max_speed = None
+
+        # compressed sparse row adjacency: the neighbors of node i and the
+        # streets leading to them are found at positions
+        # adjacency_offsets[i] to adjacency_offsets[i+1]-1
+        self.adjacency_offsets = array("i", [0])
+        self.adjacency_nodes = array("i")
+        self.adjacency_streets = array("i")
+
+        # streets added since the adjacency was last built, only used while
+        # the network is being constructed
+        self._pending_streets = dict()
+
+        # created on first use, see shortestpaths.py
+        self._shortest_path_engine = None
+
+
+    def __getstate__(self):
+        # the shortest path engine only holds caches and is not persisted
+        state = self.__dict__.copy()
+        state["_shortest_path_engine"] = None
+        return state
+
+
+    def has_street(self, street):
+        origin = self.node_indices.get(street[0])
+        destination = self.node_indices.get(street[1])
+        if origin is None or destination is None:
+            return False
+        if (min(origin, destination), max(origin, destination)) in self._pending_streets:
+            return True
+        return self._find_street(origin, destination) >= 0
+
+
+    def add_street(self, street, length, max_speed, geometry = None):
+        origin = self.node_indices[street[0]]
+        destination = self.node_indices[street[1]]
+        if self.has_street(street):
+            raise ValueError("Street " + str(street) + " is already part of the street network")
+
+        if geometry:
+            if street[0] > street[1]:
+                geometry = reversed(geometry)
+            for longitude, latitude in geometry:
+                self.geometry_longitudes.append(longitude)
+                self.geometry_latitudes.append(latitude)
+        self.geometry_offsets.append(len(self.geometry_longitudes))
+
+        self.street_origins.append(origin)
+        self.street_destinations.append(destination)
+        self.street_lengths.append(length)
+        self.street_max_speeds.append(max_speed)
+        self._max_speed = None
+        # set initial weight to ideal driving time
+        self.street_driving_times.append(length / max_speed)
+        self._pending_streets[(min(origin, destination), max(origin, destination))] = self.street_index
+
+        self.street_index += 1
+
+
+    def set_driving_time(self, street, driving_time):
+        self.street_driving_times[self._street_index_or_fail(street)] = driving_time
+        self.driving_time_version += 1
+
+
+    def set_driving_times(self, driving_times):
+        # driving times for all streets, indexed by street index
+        assign_array(self.street_driving_times, driving_times)
+        self.driving_time_version += 1
+
+
+    def get_driving_time(self, street):
+        return self.street_driving_times[self._street_index_or_fail(street)]
+
+
+    def get_street_index(self, street):
+        return self._street_index_or_fail(street)
+
+
+    def get_street_by_index(self, street_index):
+        if 0 <= street_index < self.street_index:
+            return (self.node_ids[self.street_origins[street_index]], self.node_ids[self.street_destinations[street_index]])
+        else:
+            return None
+
+
+    def get_street_geometry(self, street_index):
+        # (longitude, latitude) of the points between the end nodes of a
+        # street, from the lower node id to the higher one
+        start = self.geometry_offsets[street_index]
+        end = self.geometry_offsets[street_index + 1]
+        return zip(self.geometry_longitudes[start:end], self.geometry_latitudes[start:end])
+
+
+    def get_street_lengths(self):
+        return self.street_lengths
+
+
+    def get_max_speeds(self):
+        return self.street_max_speeds
+
+
+    def set_max_speeds(self, max_speeds):
+        # max speeds for all streets, indexed by street index
+        if len(max_speeds) != self.street_index:
+            raise ValueError("Expected max speeds for " + str(self.street_index) + " streets, got " + str(len(max_speeds)))
+        assign_array(self.street_max_speeds, max_speeds)
+        self._max_speed = None
+
+
+    def change_maxspeed(self, street, max_speed_delta):
+        # returns whether the max speed actually changed
+        street_index = self._street_index_or_fail(street)
+        current_max_speed = self.street_max_speeds[street_index]
+        self.street_max_speeds[street_index] = max(1, min(140, current_max_speed + max_speed_delta))
+        self._max_speed = None
+        return self.street_max_speeds[street_index] != current_max_speed
+
+
+    def change_max_speeds(self, street_indices, max_speed_delta):
+        # same as change_maxspeed for many streets at once, given by index
+        if numpy is not None:
+            street_indices = numpy.asarray(street_indices, dtype = numpy.int64)
+            max_speeds = as_numpy(self.street_max_speeds)
+            max_speeds[street_indices] = numpy.clip(max_speeds[street_indices] + max_speed_delta, 1, 140)
+        else:
+            for street_index in street_indices:
+                self.street_max_speeds[street_index] = max(1, min(140, self.street_max_speeds[street_index] + max_speed_delta))
+        self._max_speed = None
+
+
+    def get_max_speed(self):
+        if self._max_speed is None:
+            self._max_speed = max(self.street_max_speeds)
+        return self._max_speed
+
+
+    def set_bounds(self, min_latitude, max_latitude, min_longitude, max_longitude):
+        self.bounds = ((min_latitude, max_latitude), (min_longitude, max_longitude))
+
+
+    def add_node(self, node, longitude, latitude):
+        if node in self.node_indices:
+            raise ValueError("Node " + str(node) + " is already part of the street network")
+        self.node_indices[node] = len(self.node_ids)
+        self.node_ids.append(node)
+        self.node_longitudes.append(longitude)
+        self.node_latitudes.append(latitude)
+        # new nodes have no neighbors yet
+        self.adjacency_offsets.append(self.adjacency_offsets[-1])
+
+
+    def get_nodes(self):
+        return self.node_ids.tolist()
+
+
+    def node_coordinates(self, node):
+        node_index = self.node_indices[node]
+
+        return (self.node_longitudes[node_index], self.node_latitudes[node_index])
+
+
+    def has_node(self, node):
+        return node in self.node_indices
+
+
+    def prepare_shortest_paths(self, filename = None):
+        # let the shortest path engine do its preprocessing, if it has any
+        if self._shortest_path_engine is None:
+            self._shortest_path_engine = create_shortest_path_engine()
+        if hasattr(self._shortest_path_engine, "prepare"):
+            self._shortest_path_engine.prepare(self, filename)
+
+
+    def calculate_shortest_paths(self, origin_node, goal_nodes = None):
+        if self._shortest_path_engine is None:
+            self._shortest_path_engine = create_shortest_path_engine()
+        goals = None
+        if goal_nodes is not None:
+            goals = [self.node_indices[goal] for goal in goal_nodes if goal in self.node_indices]
+        predecessors, predecessor_streets, order = self._shortest_path_engine.calculate(self, self.node_indices[origin_node], goals)
+
+        # translate the dense predecessor array back to OSM node ids, only
+        # looking at the settled nodes if the engine tells us which they are
+        node_ids = self.node_ids
+        previous = {origin_node: None}
+        if order is None:
+            for node, predecessor in enumerate(predecessors.tolist()):
+                if predecessor >= 0:
+                    previous[node_ids[node]] = node_ids[predecessor]
+        else:
+            for node in order:
+                predecessor = predecessors[node]
+                if predecessor >= 0:
+                    previous[node_ids[node]] = node_ids[predecessor]
+
+        return previous
+
+
+    def calculate_shortest_path_tree(self, origin_node, goal_nodes = None):
+        # returns the origin and goals as dense node indices together with the
+        # predecessor and the street leading to every node of the tree (-1 for
+        # the origin and nodes that have not been reached)
+        if self._shortest_path_engine is None:
+            self._shortest_path_engine = create_shortest_path_engine()
+        origin = self.node_indices[origin_node]
+        goals = None
+        if goal_nodes is not None:
+            goals = [self.node_indices[goal] for goal in goal_nodes if goal in self.node_indices]
+        predecessors, predecessor_streets, order = self._shortest_path_engine.calculate(self, origin, goals)
+
+        return origin, goals, predecessors, predecessor_streets
+
+
+    def shortest_path_statistics(self):
+        # counters of engines that keep their trees between steps (see
+        # dynamicpaths.py), reset on every call; None for other engines
+        if not hasattr(self._shortest_path_engine, "pop_statistics"):
+            return None
+        return self._shortest_path_engine.pop_statistics()
+
+
+    def get_adjacency(self):
+        self._build_adjacency()
+        return (self.adjacency_offsets, self.adjacency_nodes, self.adjacency_streets)
+
+
+    def connected_components(self):
+        # label every node with the number of its connected component,
+        # numbered from 1 like pygraph does
+        self._build_adjacency()
+        components = array("i", [0]) * len(self.node_ids)
+        component = 0
+        for start in xrange(len(self.node_ids)):
+            if components[start] != 0:
+                continue
+            component += 1
+            components[start] = component
+            stack = [start]
+            while stack:
+                node = stack.pop()
+                for i in xrange(self.adjacency_offsets[node], self.adjacency_offsets[node + 1]):
+                    neighbor = self.adjacency_nodes[i]
+                    if components[neighbor] == 0:
+                        components[neighbor] = component
+                        stack.append(neighbor)
+
+        return dict(zip(self.node_ids, components))
+
+
+    # iterator to iterate over the streets and their attributes
+    def __iter__(self):
+        node_ids = self.node_ids
+        for street_index in xrange(self.street_index):
+            origin = node_ids[self.street_origins[street_index]]
+            destination = node_ids[self.street_destinations[street_index]]
+            # report streets with the lower node id first like StreetNetwork
+            street = (min(origin, destination), max(origin, destination))
+
+            yield (street, street_index, self.street_lengths[street_index], self.street_max_speeds[street_index])
+
+
+    def _street_index_or_fail(self, street):
+        self._build_adjacency()
+        street_index = self._find_street(self.node_indices[street[0]], self.node_indices[street[1]])
+        if street_index < 0:
+            raise KeyError(street)
+        return street_index
+
+
+    def _find_street(self, origin, destination):
+        # scan the (short) neighbor list of the origin node
+        offsets = self.adjacency_offsets
+        for i in xrange(offsets[origin], offsets[origin + 1]):
+            if self.adjacency_nodes[i] == destination:
+                return self.adjacency_streets[i]
+        return -1
+
+
+    def _build_adjacency(self):
+        if not self._pending_streets:
+            return
+
+        number_of_nodes = len(self.node_ids)
+        number_of_streets = self.street_index
+
+        # count the degree of every node, each street is used in both directions
+        degrees = array("i", [0]) * (number_of_nodes + 1)
+        for street_index in xrange(number_of_streets):
+            degrees[self.street_origins[street_index]] += 1
+            degrees[self.street_destinations[street_index]] += 1
+
+        offsets = array("i", [0]) * (number_of_nodes + 1)
+        for node in xrange(number_of_nodes):
+            offsets[node + 1] = offsets[node] + degrees[node]
+
+        # fill in the neighbors using the degree array as insertion cursor
+        neighbors = array("i", [0]) * (2 * number_of_streets)
+        streets = array("i", [0]) * (2 * number_of_streets)
+        for street_index in xrange(number_of_streets):
+            origin = self.street_origins[street_index]
+            destination = self.street_destinations[street_index]
+            degrees[origin] -= 1
+            position = offsets[origin] + degrees[origin]
+            neighbors[position] = destination
+            streets[position] = street_index
+            degrees[destination] -= 1
+            position = offsets[destination] + degrees[destination]
+            neighbors[position] = origin
+            streets[position] = street_index
+
+        self.adjacency_offsets = offsets
+        self.adjacency_nodes = neighbors
+        self.adjacency_streets = streets
+        self._pending_streets = dict()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# benchmarks.py
+# Copyright 2012 Julian Fietkau <http://www.julian-fietkau.de/>,
+#                Joachim Nitschke
+#
+# This file is part of Streets4MPI.
+#
+# Streets4MPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Streets4MPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sys
+from array import array
+from random import Random
+from time import time
+
+from streetnetwork import create_street_network
+from shortestpaths import create_shortest_path_engine
+from simulation import calculate_driving_speed, calculate_driving_speed_var, calculate_driving_speeds, calculate_driving_speeds_var, calculate_driving_times
+from utils import haversine
+
+# This function builds a square grid street network with random detours and
+# speed limits, the same for every backend given the same seed
+def build_grid_network(backend, size, random_seed = 42):
+    generator = Random(random_seed)
+    street_network = create_street_network(backend)
+    street_network.set_bounds(53.5, 53.5 + size * 0.001, 10.0, 10.0 + size * 0.0015)
+    coordinates = dict()
+    for row in range(size):
+        for column in range(size):
+            coordinates[row * size + column] = (10.0 + column * 0.0015, 53.5 + row * 0.001)
+            street_network.add_node(row * size + column, 10.0 + column * 0.0015, 53.5 + row * 0.001)
+    for row in range(size):
+        for column in range(size):
+            node = row * size + column
+            for neighbor in (node + 1 if column + 1 < size else None, node + size if row + 1 < size else None):
+                if neighbor is not None:
+                    length = haversine(*(coordinates[node] + coordinates[neighbor])) * generator.uniform(1.0, 1.5)
+                    street_network.add_street((node, neighbor), length, generator.choice((30, 50, 70)))
+    return street_network
+
+def benchmark_shortest_paths(size, number_of_origins):
+    origins = Random(7).sample(range(size * size), number_of_origins)
+    reference_network = build_grid_network("pygraph", size)
+    array_network = build_grid_network("array", size)
+
+    print "Grid:", size, "x", size, "nodes,", array_network.street_index, "streets,", number_of_origins, "origins"
+
+    start = time()
+    reference = [reference_network.calculate_shortest_paths(origin) for origin in origins]
+    reference_time = time() - start
+    print "  pygraph: ", reference_time, " seconds"
+
+    for engine in ("heap", "scipy"):
+        try:
+            array_network._shortest_path_engine = create_shortest_path_engine(engine)
+        except ImportError:
+            print "  " + engine + ": not available"
+            continue
+        start = time()
+        results = [array_network.calculate_shortest_paths(origin) for origin in origins]
+        engine_time = time() - start
+        print "  " + engine + ": ", engine_time, " seconds (" + str(round(reference_time / engine_time, 1)) + "x),",
+        print "same predecessors" if results == reference else "PREDECESSORS DIFFER"
+
+def path_driving_time(street_network, paths, goal):
+    driving_time = 0
+    while paths[goal] is not None:
+        driving_time += street_network.get_driving_time((goal, paths[goal]))
+        goal = paths[goal]
+    return driving_time
+
+def benchmark_goal_bounded_search(size, number_of_origins, goals_per_origin):
+    generator = Random(7)
+    street_network = build_grid_network("array", size)
+    trips = [(generator.randrange(size * size), generator.sample(range(size * size), goals_per_origin)) for i in range(number_of_origins)]
+
+    print "Grid:", size, "x", size, "nodes,", number_of_origins, "origins with", goals_per_origin, "goals each"
+
+    reference = None
+    for search in ("full", "goals", "astar"):
+        street_network._shortest_path_engine = create_shortest_path_engine("heap", search)
+        settled_nodes = 0
+        start = time()
+        results = []
+        for origin, goals in trips:
+            results.append(street_network.calculate_shortest_paths(origin, goals))
+            settled_nodes += len(results[-1])
+        search_time = time() - start
+        if reference is None:
+            reference = results
+        same = all(abs(path_driving_time(street_network, result[0], goal) - path_driving_time(street_network, result[1], goal)) < 1e-6
+                   for result, trip in zip(zip(reference, results), trips) for goal in trip[1])
+        print "  " + search + ": ", search_time, " seconds,", settled_nodes / number_of_origins, "nodes per origin,",
+        print "same goal distances" if same else "GOAL DISTANCES DIFFER"
+
+def benchmark_edge_preparation(size, jam_tolerance = 0.5):
+    generator = Random(11)
+    print "Grid:", size, "x", size, "nodes, edge preparation"
+
+    for backend in ("pygraph", "array"):
+        street_network = build_grid_network(backend, size)
+        traffic_load = array("I", [generator.randrange(0, 200) for i in range(street_network.street_index)])
+
+        # street by street, as Simulation.step used to do it
+        start = time()
+        scalar_driving_times = [0] * street_network.street_index
+        for street, street_index, length, max_speed in street_network:
+            ideal_speed = calculate_driving_speed(length, max_speed, 0)
+            actual_speed = calculate_driving_speed(length, max_speed, traffic_load[street_index])
+            perceived_speed = actual_speed + (ideal_speed - actual_speed) * jam_tolerance
+            scalar_driving_times[street_index] = length / perceived_speed
+            street_network.set_driving_time(street, scalar_driving_times[street_index])
+        scalar_time = time() - start
+
+        # all streets at once
+        start = time()
+        driving_times = calculate_driving_times(street_network.get_street_lengths(), street_network.get_max_speeds(), traffic_load, jam_tolerance)
+        street_network.set_driving_times(driving_times)
+        batched_time = time() - start
+
+        lengths = street_network.get_street_lengths()
+        max_speeds = street_network.get_max_speeds()
+        identical = (list(driving_times) == scalar_driving_times
+                     and list(calculate_driving_speeds(lengths, max_speeds, traffic_load)) == map(calculate_driving_speed, lengths, max_speeds, traffic_load)
+                     and list(calculate_driving_speeds_var(lengths, max_speeds, traffic_load)) == map(calculate_driving_speed_var, lengths, max_speeds, traffic_load))
+        print "  " + backend + ": street by street", scalar_time, "seconds, batched", batched_time, "seconds (" + str(round(scalar_time / batched_time, 1)) + "x),",
+        print "identical results" if identical else "RESULTS DIFFER"
+
+if __name__ == "__main__":
+    size = 100
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+
+    benchmark_shortest_paths(size, 10)
+    benchmark_goal_bounded_search(size, 20, 2)
+    benchmark_edge_preparation(size)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# checkpoint.py
+# Copyright 2012 Julian Fietkau <http://www.julian-fietkau.de/>,
+#                Joachim Nitschke
+#
+# This file is part of Streets4MPI.
+#
+# Streets4MPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Streets4MPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from os import path, makedirs, rename, remove, getpid
+
+from persistence import persist_serialize, persist_deserialize
+
+# Every process writes its own part of a checkpoint to a file of its own.
+# Once all of them are done, the first process points the marker file to the
+# new checkpoint, so that a checkpoint is only ever used if it is complete,
+# and the processes remove their part of the previous one.
+
+CHECKPOINT_VERSION = 2
+MARKER_FILENAME = "checkpoint.s4mpi"
+
+def checkpoint_filename(directory, step, process_rank):
+    return path.join(directory, "checkpoint_" + str(step) + "_" + str(process_rank) + ".s4mpi")
+
+# This function writes the state of this process for the given step (the
+# next one to simulate) as part of a checkpoint. It must be called by all
+# processes together.
+def write_checkpoint(communicator, directory, step, state):
+    process_rank = communicator.Get_rank()
+    if process_rank == 0 and not path.isdir(directory):
+        makedirs(directory)
+    communicator.Barrier()
+
+    state = dict(state)
+    state["version"] = CHECKPOINT_VERSION
+    state["step"] = step
+    state["processes"] = communicator.Get_size()
+    _write_file(checkpoint_filename(directory, step, process_rank), state)
+    communicator.Barrier()
+
+    previous_step = None
+    if process_rank == 0:
+        marker_filename = path.join(directory, MARKER_FILENAME)
+        if path.exists(marker_filename):
+            previous_step = _read_file(marker_filename)["step"]
+        _write_file(marker_filename, { "version" : CHECKPOINT_VERSION, "step" : step, "processes" : communicator.Get_size() })
+    previous_step = communicator.bcast(previous_step)
+
+    if previous_step is not None and previous_step != step:
+        previous_filename = checkpoint_filename(directory, previous_step, process_rank)
+        if path.exists(previous_filename):
+            remove(previous_filename)
+
+# This function returns the state this process wrote as part of the last
+# complete checkpoint, or None if there is none. It must be called by all
+# processes together.
+def read_checkpoint(communicator, directory):
+    # the first process reads the marker and all processes check it, so that
+    # they all fail together if the checkpoint cannot be used
+    marker = None
+    if communicator.Get_rank() == 0:
+        marker_filename = path.join(directory, MARKER_FILENAME)
+        if path.exists(marker_filename):
+            marker = _read_file(marker_filename)
+    marker = communicator.bcast(marker)
+    if marker is None:
+        return None
+    if marker["version"] != CHECKPOINT_VERSION:
+        raise ValueError("Unsupported checkpoint version " + str(marker["version"]))
+    if marker["processes"] != communicator.Get_size():
+        raise ValueError("The checkpoint was written by " + str(marker["processes"]) + " processes, not " +
+                         str(communicator.Get_size()))
+
+    return _read_file(checkpoint_filename(directory, marker["step"], communicator.Get_rank()))
+
+def _write_file(filename, data):
+    # write to a temporary file first so that a process that dies while
+    # writing never leaves a half-written file behind
+    temporary_filename = filename + "." + str(getpid())
+    checkpoint_file = open(temporary_filename, "wb")
+    try:
+        checkpoint_file.write(persist_serialize(data))
+    finally:
+        checkpoint_file.close()
+    rename(temporary_filename, filename)
+
+def _read_file(filename):
+    checkpoint_file = open(filename, "rb")
+    try:
+        return persist_deserialize(checkpoint_file.read())
+    finally:
+        checkpoint_file.close()
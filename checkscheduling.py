@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# checkscheduling.py
+# Copyright 2012 Julian Fietkau <http://www.julian-fietkau.de/>,
+#                Joachim Nitschke
+#
+# This file is part of Streets4MPI.
+#
+# Streets4MPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Streets4MPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sys
+from array import array
+from itertools import repeat
+
+from mpi4py import MPI
+
+from benchmarks import build_grid_network
+from tripgenerator import TripGenerator
+from simulation import Simulation
+from scheduler import OriginScheduler
+
+# This script checks that static and dynamic origin scheduling give the same
+# traffic loads. Run it with several processes, e.g.
+# mpiexec -n 3 python checkscheduling.py
+
+def quiet(*output):
+    pass
+
+# This function simulates the given number of steps on a grid and returns
+# the total traffic load of every step
+def simulate(communicator, dynamic_scheduling, size, number_of_residents, number_of_steps, random_seed = 3756917):
+    street_network = build_grid_network("array", size)
+    nodes = street_network.get_nodes()
+    number_of_processes = communicator.Get_size()
+    def generate_trip_table(process_rank):
+        trip_generator = TripGenerator(random_seed + 37 * process_rank)
+        return trip_generator.generate_trips(number_of_residents / number_of_processes, nodes, nodes)
+    if dynamic_scheduling:
+        trip_tables = [generate_trip_table(process_rank) for process_rank in range(number_of_processes)]
+    else:
+        trip_tables = [generate_trip_table(communicator.Get_rank())]
+
+    simulation = Simulation(street_network, trip_tables, quiet)
+    scheduler = None
+    if dynamic_scheduling:
+        scheduler = OriginScheduler(communicator, simulation.trip_keys())
+    traffic_loads = []
+    for step in range(number_of_steps):
+        if scheduler is not None:
+            simulation.step(scheduler.origins_for_step())
+            scheduler.end_step(simulation.origin_costs)
+        else:
+            simulation.step()
+        total_traffic_load = array("I", repeat(0, street_network.street_index))
+        communicator.Allreduce(simulation.traffic_load, total_traffic_load, MPI.SUM)
+        simulation.traffic_load = total_traffic_load
+        traffic_loads.append(total_traffic_load)
+    if scheduler is not None:
+        scheduler.close()
+    return traffic_loads
+
+if __name__ == "__main__":
+    size = 30
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+
+    communicator = MPI.COMM_WORLD
+    static_traffic_loads = simulate(communicator, False, size, 300, 5)
+    dynamic_traffic_loads = simulate(communicator, True, size, 300, 5)
+    if communicator.Get_rank() == 0:
+        print "Grid:", size, "x", size, "nodes,", communicator.Get_size(), "processes"
+        if static_traffic_loads == dynamic_traffic_loads:
+            print "  static and dynamic scheduling: same traffic loads"
+        else:
+            print "  static and dynamic scheduling: TRAFFIC LOADS DIFFER"
+            sys.exit(1)
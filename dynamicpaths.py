@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# dynamicpaths.py
+# Copyright 2012 Julian Fietkau <http://www.julian-fietkau.de/>,
+#                Joachim Nitschke
+#
+# This file is part of Streets4MPI.
+#
+# Streets4MPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Streets4MPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from array import array
+from heapq import heappush, heappop
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+INFINITY = float("inf")
+
+# This class keeps the shortest path tree of every origin from one step to
+# the next and only repairs the parts of it that are affected by changed
+# driving times (dynamic Dijkstra in the spirit of Ramalingam and Reps):
+# nodes below streets of the tree that got slower lose their distance and
+# are searched again from their unaffected neighbors, together with the
+# nodes that can be reached faster through streets that got faster.
+#
+# The trees are exact for a set of reference driving times, which only take
+# over a street's current driving time if it differs by more than the
+# tolerance (relative to the reference). If more than the fallback share of
+# all streets changes at once, or the part of a tree to repair is larger
+# than that share of all nodes, trees are calculated from scratch with the
+# full engine.
+class DynamicDijkstra(object):
+
+    def __init__(self, full_engine, tolerance = 0.0, fallback = 0.1):
+        self.full_engine = full_engine
+        self.tolerance = tolerance
+        self.fallback = fallback
+        # reference driving times the trees are exact for
+        self.driving_times = None
+        self._driving_time_version = None
+        # incremented whenever the reference driving times change; a tree can
+        # only be repaired if it is exact for the previous generation
+        self._generation = 0
+        # streets changed since the previous generation and their previous
+        # driving times (None if all trees need to be calculated again)
+        self._changed_streets = None
+        self._previous_driving_times = None
+        # generation, distances, predecessors and predecessor streets of the
+        # tree of every origin (node index)
+        self._trees = dict()
+        self.statistics = self._empty_statistics()
+
+
+    def calculate(self, street_network, origin, goals = None):
+        # always calculates the full tree, the goals do not matter
+        if street_network.driving_time_version != self._driving_time_version:
+            self._update_driving_times(street_network)
+
+        tree = self._trees.get(origin)
+        if tree is not None and tree[0] == self._generation:
+            self.statistics["reused"] += 1
+        elif tree is not None and self._changed_streets is not None and self._repair(street_network, origin, tree):
+            self.statistics["repaired"] += 1
+        else:
+            tree = self._calculate_tree(street_network, origin)
+            self.statistics["recalculated"] += 1
+        tree[0] = self._generation
+
+        return tree[2], tree[3], None
+
+
+    def pop_statistics(self):
+        # number of trees used as they were, repaired or calculated again and
+        # the number of nodes searched during repairs since the last call
+        statistics = self.statistics
+        self.statistics = self._empty_statistics()
+        return statistics
+
+
+    def _empty_statistics(self):
+        return { "reused" : 0, "repaired" : 0, "recalculated" : 0, "repaired_nodes" : 0 }
+
+
+    def _update_driving_times(self, street_network):
+        self._driving_time_version = street_network.driving_time_version
+        current = street_network.street_driving_times
+        if self.driving_times is None or len(self.driving_times) != len(current):
+            changed_streets = None
+        elif numpy is not None:
+            reference = numpy.frombuffer(self.driving_times, dtype = numpy.float64)
+            current_values = numpy.frombuffer(current, dtype = numpy.float64)
+            changed_streets = numpy.flatnonzero(numpy.abs(current_values - reference) > self.tolerance * reference).tolist()
+        else:
+            changed_streets = [street for street, (reference, value) in enumerate(zip(self.driving_times, current))
+                               if abs(value - reference) > self.tolerance * reference]
+
+        if changed_streets is not None and len(changed_streets) == 0:
+            # all trees are still exact
+            return
+
+        if changed_streets is None or len(changed_streets) > self.fallback * len(current):
+            self.driving_times = array("d", current)
+            self._changed_streets = None
+            self._previous_driving_times = None
+            self._trees = dict()
+        else:
+            self._changed_streets = changed_streets
+            self._previous_driving_times = [self.driving_times[street] for street in changed_streets]
+            for street in changed_streets:
+                self.driving_times[street] = current[street]
+            # only trees of the previous generation can be repaired
+            generation = self._generation
+            self._trees = dict((origin, tree) for origin, tree in self._trees.iteritems() if tree[0] == generation)
+        self._generation += 1
+
+
+    def _calculate_tree(self, street_network, origin):
+        distances, predecessors, predecessor_streets = self.full_engine.calculate_tree(street_network, origin, self.driving_times,
+                                                                                       ("dynamic", self._generation))
+        if not isinstance(distances, array):
+            # repairs are faster on plain arrays than on numpy arrays
+            distances = array("d", distances.astype(numpy.float64).tostring())
+            predecessors = array("i", predecessors.astype(numpy.int32).tostring())
+            predecessor_streets = array("i", predecessor_streets.astype(numpy.int32).tostring())
+        tree = [self._generation, distances, predecessors, predecessor_streets]
+        self._trees[origin] = tree
+        return tree
+
+
+    def _repair(self, street_network, origin, tree):
+        # returns False if too much of the tree is affected to repair it
+        offsets, neighbors, streets = street_network.get_adjacency()
+        street_origins = street_network.street_origins
+        street_destinations = street_network.street_destinations
+        driving_times = self.driving_times
+        distances, predecessors, predecessor_streets = tree[1], tree[2], tree[3]
+        number_of_nodes = len(offsets) - 1
+
+        # everything below a street of the tree that got slower is affected
+        affected = []
+        is_affected = bytearray(number_of_nodes)
+        for street, previous_driving_time in zip(self._changed_streets, self._previous_driving_times):
+            if driving_times[street] <= previous_driving_time:
+                continue
+            for node in (street_origins[street], street_destinations[street]):
+                if predecessor_streets[node] == street and not is_affected[node]:
+                    is_affected[node] = 1
+                    affected.append(node)
+        position = 0
+        while position < len(affected):
+            node = affected[position]
+            position += 1
+            for i in xrange(offsets[node], offsets[node + 1]):
+                child = neighbors[i]
+                if predecessor_streets[child] == streets[i] and predecessors[child] == node and not is_affected[child]:
+                    is_affected[child] = 1
+                    affected.append(child)
+        if len(affected) > self.fallback * number_of_nodes:
+            return False
+
+        for node in affected:
+            distances[node] = INFINITY
+            predecessors[node] = -1
+            predecessor_streets[node] = -1
+
+        # affected nodes start from their best unaffected neighbor
+        queue = []
+        for node in affected:
+            best_distance = INFINITY
+            for i in xrange(offsets[node], offsets[node + 1]):
+                neighbor = neighbors[i]
+                if not is_affected[neighbor]:
+                    alternative = distances[neighbor] + driving_times[streets[i]]
+                    if alternative < best_distance:
+                        best_distance = alternative
+                        predecessors[node] = neighbor
+                        predecessor_streets[node] = streets[i]
+            if best_distance < INFINITY:
+                distances[node] = best_distance
+                heappush(queue, (best_distance, node))
+
+        # streets that got faster may lead to shorter paths
+        for street, previous_driving_time in zip(self._changed_streets, self._previous_driving_times):
+            driving_time = driving_times[street]
+            if driving_time >= previous_driving_time:
+                continue
+            for node, other_node in ((street_origins[street], street_destinations[street]),
+                                     (street_destinations[street], street_origins[street])):
+                alternative = distances[node] + driving_time
+                if alternative < distances[other_node]:
+                    distances[other_node] = alternative
+                    predecessors[other_node] = node
+                    predecessor_streets[other_node] = street
+                    heappush(queue, (alternative, other_node))
+
+        # Dijkstra's algorithm from there on, every node whose distance
+        # improves is searched again
+        searched_nodes = 0
+        while queue:
+            distance, node = heappop(queue)
+            if distance > distances[node]:
+                continue
+            searched_nodes += 1
+            for i in xrange(offsets[node], offsets[node + 1]):
+                neighbor = neighbors[i]
+                alternative = distance + driving_times[streets[i]]
+                if alternative < distances[neighbor]:
+                    distances[neighbor] = alternative
+                    predecessors[neighbor] = node
+                    predecessor_streets[neighbor] = streets[i]
+                    heappush(queue, (alternative, neighbor))
+
+        self.statistics["repaired_nodes"] += searched_nodes
+        return True
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# networkcache.py
+# Copyright 2012 Julian Fietkau <http://www.julian-fietkau.de/>,
+#                Joachim Nitschke
+#
+# This file is part of Streets4MPI.
+#
+# Streets4MPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Streets4MPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from hashlib import sha1
+from os import path, makedirs
+from time import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from osmdata import GraphBuilder
+from simplification import simplify_street_network
+from streetnetwork import convert_street_network
+from networkio import write_network_file, read_network_file, VERSION
+from settings import settings
+
+# This function returns a key that changes whenever the OSM file or the way
+# the street network is built from it changes
+def street_network_cache_key(osm_file):
+    key = sha1()
+    osm = open(osm_file, "rb")
+    try:
+        while True:
+            data = osm.read(1 << 20)
+            if not data:
+                break
+            key.update(data)
+    finally:
+        osm.close()
+    key.update(repr((VERSION, GraphBuilder.parameters(settings["street_length_formula"]), settings["simplify_street_network"])))
+    return key.hexdigest()
+
+# This function returns the street network built from the OSM file together
+# with the connected residential, commercial and industrial nodes. If a cache
+# directory is set, the result is read from there if the OSM file has been
+# built before and stored there otherwise. concurrency is the number of
+# processes used to build the network.
+def load_street_network(osm_file, concurrency, log_callback, log_indent_callback):
+    cache_directory = settings["street_network_cache_directory"]
+    if cache_directory is None:
+        return build_street_network(osm_file, concurrency, log_callback, log_indent_callback)
+
+    cache_filename = path.join(cache_directory, "street_network_" + street_network_cache_key(osm_file) + ".s4mpi")
+    if not path.exists(cache_filename):
+        street_network, node_categories = build_street_network(osm_file, concurrency, log_callback, log_indent_callback)
+        log_callback("Writing street network cache...")
+        if not path.isdir(cache_directory):
+            makedirs(cache_directory)
+        write_network_file(cache_filename, street_network, node_categories)
+
+    # the network is always used as read back from the cache, so that a run
+    # that builds the cache behaves exactly like the ones that reuse it; the
+    # arrays that never change are only read from disk when they are needed
+    log_callback("Reading street network cache...")
+    street_network, node_categories = read_network_file(cache_filename, share_topology = numpy is not None)
+    return convert_street_network(street_network), tuple(node_categories)
+
+def build_street_network(osm_file, concurrency, log_callback, log_indent_callback):
+    log_callback("Reading OpenStreetMap data...")
+    data = GraphBuilder(osm_file, concurrency, settings["street_length_formula"])
+    log_indent_callback("Parsing took", round(data.stage_timings["parsing"], 3), "s")
+
+    log_callback("Building street network...")
+    street_network = data.build_street_network()
+    building_time = data.stage_timings["street_network"]
+    log_indent_callback("Building took", round(building_time, 3), "s for", data.number_of_segments, "way segments",
+                        "(" + str(int(data.number_of_segments / max(building_time, 1e-6))), "segments/s)")
+
+    log_callback("Locating area types...")
+    data.find_node_categories()
+    log_indent_callback("Locating took", round(data.stage_timings["node_categories"], 3), "s")
+    node_categories = (data.connected_residential_nodes, data.connected_commercial_nodes, data.connected_industrial_nodes)
+
+    if settings["simplify_street_network"]:
+        log_callback("Simplifying street network...")
+        start = time()
+        number_of_streets = street_network.street_index
+        # possible origins and goals must remain nodes of the network
+        street_network = simplify_street_network(street_network, frozenset().union(*node_categories))
+        log_indent_callback("Reduced", number_of_streets, "streets to", street_network.street_index, "in", round(time() - start, 3), "s")
+
+    return street_network, node_categories
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# networkio.py
+# Copyright 2012 Julian Fietkau <http://www.julian-fietkau.de/>,
+#                Joachim Nitschke
+#
+# This file is part of Streets4MPI.
+#
+# Streets4MPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Streets4MPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import struct
+import mmap
+from array import array
+from os import path, rename, getpid
+from threading import Thread
+from Queue import Queue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from arraystreetnetwork import ArrayStreetNetwork
+from streetnetwork import convert_street_network
+from persistence import persist_write, persist_read
+from utils import NUMPY_TYPES, as_numpy
+
+# Compact binary form of an ArrayStreetNetwork: a header followed by the raw
+# contents of its arrays, each one starting at a multiple of 8 bytes so that
+# it can be used in place (e.g. from shared or memory-mapped memory).
+
+MAGIC = "S4MPINET"
+VERSION = 2
+
+# arrays that never change once the network is built
+TOPOLOGY_FIELDS = ("node_ids", "node_longitudes", "node_latitudes",
+                   "street_origins", "street_destinations", "street_lengths",
+                   "adjacency_offsets", "adjacency_nodes", "adjacency_streets",
+                   "geometry_offsets", "geometry_longitudes", "geometry_latitudes")
+# arrays that change during the simulation
+STATE_FIELDS = ("street_max_speeds", "street_driving_times")
+FIELDS = TOPOLOGY_FIELDS + STATE_FIELDS
+
+# magic, version, number of streets, bounds (NaN if there are none)
+HEADER = struct.Struct("<8sIQ4d")
+# type code and number of items of every array
+FIELD_HEADER = struct.Struct("<cQ")
+# number of node sets stored after the street network in files, followed by
+# the number of nodes in every set
+SET_COUNT = struct.Struct("<Q")
+
+def _aligned(size):
+    return (size + 7) & ~7
+
+def _typecode(values):
+    # arrays read with share_topology are numpy arrays
+    if isinstance(values, array):
+        return values.typecode
+    for typecode, dtype in NUMPY_TYPES.iteritems():
+        if values.dtype == dtype:
+            return typecode
+    raise TypeError("Unsupported array type: " + str(values.dtype))
+
+def packed_size(street_network):
+    size = _aligned(HEADER.size + len(FIELDS) * FIELD_HEADER.size)
+    for field in FIELDS:
+        values = getattr(street_network, field)
+        size += _aligned(len(values) * values.itemsize)
+    return size
+
+def _packed_header(street_network):
+    # header and array layout, padded to the start of the first array
+    if street_network.bounds is None:
+        bounds = (float("nan"),) * 4
+    else:
+        bounds = street_network.bounds[0] + street_network.bounds[1]
+    header = [HEADER.pack(MAGIC, VERSION, street_network.street_index, *bounds)]
+    for field in FIELDS:
+        values = getattr(street_network, field)
+        header.append(FIELD_HEADER.pack(_typecode(values), len(values)))
+    header = "".join(header)
+    return header + "\0" * (_aligned(len(header)) - len(header))
+
+# This function writes the binary form of a street network into a writable
+# buffer (or a new bytearray) and returns that buffer
+def pack_street_network(street_network, buffer = None):
+    # make sure the adjacency is up to date
+    street_network.get_adjacency()
+    if buffer is None:
+        buffer = bytearray(packed_size(street_network))
+
+    header = _packed_header(street_network)
+    buffer[0:len(header)] = header
+    offset = len(header)
+    for field in FIELDS:
+        data = getattr(street_network, field).tostring()
+        buffer[offset:offset + len(data)] = data
+        offset += _aligned(len(data))
+
+    return buffer
+
+def _packed_parts(street_network, copy_state = False):
+    # header and arrays of the binary form, with copy_state the arrays that
+    # change during the simulation are copies
+    street_network.get_adjacency()
+    arrays = [getattr(street_network, field) for field in FIELDS]
+    if copy_state:
+        arrays = [values[:] if field in STATE_FIELDS else values for field, values in zip(FIELDS, arrays)]
+    return _packed_header(street_network), arrays
+
+def _write_packed_parts(network_file, parts):
+    # same as pack_street_network, but writes one array after the other to a
+    # file instead of building the whole binary form in memory first
+    header, arrays = parts
+    network_file.write(header)
+    for values in arrays:
+        size = len(values) * values.itemsize
+        network_file.write(values)
+        network_file.write("\0" * (_aligned(size) - size))
+
+# This function creates a street network from its binary form. With
+# share_topology, the arrays that never change are numpy views into the
+# buffer instead of copies, so the buffer must stay alive as long as the
+# street network is used.
+def unpack_street_network(buffer, share_topology = False):
+    return _unpack_street_network(buffer, share_topology)[0]
+
+def _unpack_street_network(buffer, share_topology):
+    # returns the street network and the offset right after it
+    magic, version, number_of_streets, min_latitude, max_latitude, min_longitude, max_longitude = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a packed street network or unsupported version")
+    if share_topology and numpy is None:
+        raise ImportError("Sharing the street network topology needs NumPy")
+
+    street_network = ArrayStreetNetwork()
+    street_network.street_index = number_of_streets
+    if min_latitude == min_latitude: # not NaN
+        street_network.set_bounds(min_latitude, max_latitude, min_longitude, max_longitude)
+
+    offset = HEADER.size
+    layout = []
+    for field in FIELDS:
+        layout.append(FIELD_HEADER.unpack_from(buffer, offset))
+        offset += FIELD_HEADER.size
+
+    offset = _aligned(offset)
+    for field, (typecode, length) in zip(FIELDS, layout):
+        values = array(typecode)
+        size = length * values.itemsize
+        if share_topology and field in TOPOLOGY_FIELDS:
+            values = numpy.frombuffer(buffer, dtype = NUMPY_TYPES[typecode], count = length, offset = offset)
+        else:
+            data = buffer[offset:offset + size]
+            # slices of MPI memory and memoryviews are not strings
+            values.fromstring(data.tobytes() if hasattr(data, "tobytes") else str(data))
+        setattr(street_network, field, values)
+        offset += _aligned(size)
+
+    street_network.node_indices = dict((node, index) for index, node in enumerate(street_network.node_ids.tolist()))
+
+    return street_network, offset
+
+# This function writes a street network of any backend in binary form to a
+# file, followed by the given sets of OSM node ids
+def write_network_file(filename, street_network, node_sets = ()):
+    street_network = convert_street_network(street_network, "array")
+    node_sets = [array("l", sorted(node_set)) for node_set in node_sets]
+
+    # write to a temporary file first so that other processes never read a
+    # half-written file
+    temporary_filename = filename + "." + str(getpid())
+    network_file = open(temporary_filename, "wb")
+    try:
+        _write_packed_parts(network_file, _packed_parts(street_network))
+        network_file.write(SET_COUNT.pack(len(node_sets)))
+        for node_set in node_sets:
+            network_file.write(SET_COUNT.pack(len(node_set)))
+        for node_set in node_sets:
+            network_file.write(node_set.tostring())
+    finally:
+        network_file.close()
+    rename(temporary_filename, filename)
+
+# This function reads a file written by write_network_file and returns the
+# street network (using the "array" backend) and the list of node sets. The
+# file is memory-mapped; with share_topology, the arrays that never change
+# are read from disk only when they are used.
+def read_network_file(filename, share_topology = False):
+    network_file = open(filename, "rb")
+    try:
+        buffer = mmap.mmap(network_file.fileno(), 0, access = mmap.ACCESS_READ)
+    finally:
+        network_file.close()
+
+    street_network, offset = _unpack_street_network(buffer, share_topology)
+    number_of_sets = SET_COUNT.unpack_from(buffer, offset)[0]
+    offset += SET_COUNT.size
+    lengths = []
+    for i in xrange(number_of_sets):
+        lengths.append(SET_COUNT.unpack_from(buffer, offset)[0])
+        offset += SET_COUNT.size
+    node_sets = []
+    for length in lengths:
+        node_set = array("l")
+        node_set.fromstring(buffer[offset:offset + length * node_set.itemsize])
+        node_sets.append(set(node_set))
+        offset += length * node_set.itemsize
+
+    if not share_topology:
+        buffer.close()
+    return street_network, node_sets
+
+def is_network_file(filename):
+    network_file = open(filename, "rb")
+    try:
+        return network_file.read(len(MAGIC)) == MAGIC
+    finally:
+        network_file.close()
+
+# These functions store the street network in binary form if it uses the
+# "array" backend and pickled otherwise; reading detects the format.
+def write_street_network(filename, street_network):
+    if isinstance(street_network, ArrayStreetNetwork):
+        write_network_file(filename, street_network)
+    else:
+        persist_write(filename, street_network)
+
+def read_street_network(filename, share_topology = False):
+    if is_network_file(filename):
+        return read_network_file(filename, share_topology)[0]
+    return persist_read(filename)
+
+# A street network snapshot stores the binary form of a street network once,
+# followed by a record for every round of road construction with the
+# streets whose max speed changed and their new max speeds. Records are only
+# ever appended, so the file can be read while the simulation is running.
+
+SNAPSHOT_FILENAME = "street_network.s4mpi"
+
+# step from which on the changes apply, number of changed streets
+CHANGE_HEADER = struct.Struct("<IxxxxQ")
+
+def _change_size(number_of_streets):
+    return CHANGE_HEADER.size + _aligned(4 * number_of_streets) + 8 * number_of_streets
+
+# This class writes a street network snapshot in a background thread. Only
+# finding the changed max speeds is done by the caller, so that the street
+# network can be changed again right away.
+class NetworkSnapshotWriter(object):
+
+    def __init__(self, filename, street_network, step = None):
+        # without step, a new snapshot of the street network is written,
+        # otherwise the existing one is continued after the changes of that
+        # step (to resume from a checkpoint)
+        self.filename = filename
+        self.max_speeds = array("d", street_network.get_max_speeds())
+        self._queue = Queue()
+        self._error = None
+
+        if step is None:
+            snapshot_file = open(filename, "wb")
+            # the street network may change while it is written, so the
+            # background thread gets copies of the parts that can change
+            parts = _packed_parts(convert_street_network(street_network, "array"), copy_state = True)
+            self._queue.put((_write_packed_parts, parts))
+        else:
+            if not path.exists(filename):
+                # a new snapshot would lack the changes before the step
+                raise IOError("Cannot resume without the street network snapshot " + filename)
+            snapshot_file = open(filename, "r+b")
+            try:
+                end = _read_snapshot(snapshot_file, step)[2]
+                snapshot_file.truncate(end)
+                snapshot_file.seek(end)
+            except:
+                snapshot_file.close()
+                raise
+
+        self._thread = Thread(target = self._write, args = (snapshot_file,))
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def add(self, step, street_network):
+        # record the max speeds of the street network from the given step on
+        if self._error is not None:
+            raise self._error
+        max_speeds = street_network.get_max_speeds()
+        if numpy is not None:
+            previous = as_numpy(self.max_speeds)
+            current = numpy.asarray(max_speeds, dtype = numpy.float64)
+            changed_streets = numpy.flatnonzero(previous != current)
+            new_max_speeds = current[changed_streets]
+            previous[changed_streets] = new_max_speeds
+            changed_streets = array("I", changed_streets.astype(numpy.uint32).tostring())
+            new_max_speeds = array("d", new_max_speeds.tostring())
+        else:
+            changed_streets = array("I", [street for street in xrange(len(max_speeds)) if max_speeds[street] != self.max_speeds[street]])
+            new_max_speeds = array("d", [max_speeds[street] for street in changed_streets])
+            for street, max_speed in zip(changed_streets, new_max_speeds):
+                self.max_speeds[street] = max_speed
+        self._queue.put((_write_change, (step, changed_streets, new_max_speeds)))
+
+
+    def flush(self):
+        # waits until everything added so far is written
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+
+    def close(self):
+        # waits until everything is written
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+    def _write(self, snapshot_file):
+        try:
+            while True:
+                item = self._queue.get()
+                try:
+                    if item is None:
+                        break
+                    if self._error is not None:
+                        # the caller gets the error the next time it adds
+                        # a change
+                        continue
+                    write, data = item
+                    try:
+                        write(snapshot_file, data)
+                        snapshot_file.flush()
+                    except Exception as error:
+                        self._error = error
+                finally:
+                    self._queue.task_done()
+        finally:
+            snapshot_file.close()
+
+def _write_change(snapshot_file, change):
+    step, changed_streets, max_speeds = change
+    size = 4 * len(changed_streets)
+    snapshot_file.write(CHANGE_HEADER.pack(step, len(changed_streets)))
+    snapshot_file.write(changed_streets)
+    snapshot_file.write("\0" * (_aligned(size) - size))
+    snapshot_file.write(max_speeds)
+
+def _read_snapshot(snapshot_file, last_step = None, share_topology = False):
+    # returns the street network, the list of (step, changed streets, new max
+    # speeds) up to the given step and the offset right after that
+    buffer = mmap.mmap(snapshot_file.fileno(), 0, access = mmap.ACCESS_READ)
+    try:
+        street_network, offset = _unpack_street_network(buffer, share_topology)
+        changes = []
+        while offset + CHANGE_HEADER.size <= len(buffer):
+            step, number_of_streets = CHANGE_HEADER.unpack_from(buffer, offset)
+            # the last change may not have been written completely
+            if offset + _change_size(number_of_streets) > len(buffer) or (last_step is not None and step > last_step):
+                break
+            changed_streets = array("I")
+            changed_streets.fromstring(buffer[offset + CHANGE_HEADER.size:offset + CHANGE_HEADER.size + 4 * number_of_streets])
+            max_speeds = array("d")
+            max_speeds_offset = offset + CHANGE_HEADER.size + _aligned(4 * number_of_streets)
+            max_speeds.fromstring(buffer[max_speeds_offset:max_speeds_offset + 8 * number_of_streets])
+            changes.append((step, changed_streets, max_speeds))
+            offset += _change_size(number_of_streets)
+    finally:
+        if not share_topology:
+            buffer.close()
+    return street_network, changes, offset
+
+# This function reads a street network snapshot and returns the street
+# network as it was written first (using the "array" backend) and the list
+# of (step, changed streets, new max speeds) of every later change. With
+# share_topology, the arrays that never change are read from disk only when
+# they are used (see read_network_file).
+def read_network_snapshot(filename, share_topology = False):
+    snapshot_file = open(filename, "rb")
+    try:
+        return _read_snapshot(snapshot_file, share_topology = share_topology)[:2]
+    finally:
+        snapshot_file.close()
+
+# This function applies a change read by read_network_snapshot
+def apply_max_speed_change(street_network, changed_streets, max_speeds):
+    all_max_speeds = array("d", street_network.get_max_speeds())
+    for street, max_speed in zip(changed_streets, max_speeds):
+        all_max_speeds[street] = max_speed
+    street_network.set_max_speeds(all_max_speeds)
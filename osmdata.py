@@ -23,25 +23,92 @@
 
 from imposm.parser import OSMParser
 
-from math import sqrt, radians, sin, cos, asin
+from math import sqrt
 from time import time
+from array import array
+from multiprocessing import Pool
+from operator import itemgetter
+from itertools import repeat
 
-from streetnetwork import StreetNetwork
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from streetnetwork import create_street_network
+from utils import haversine, haversines, as_numpy
+
+NAN = float("nan")
+
+# builder whose ways the worker processes of build_street_network work on
+_worker_builder = None
+
+def _build_streets(chunk):
+    return _worker_builder.build_streets(chunk[0], chunk[1])
 
 # This class reads an OSM file and builds a graph out of it
 class GraphBuilder(object):
 
-    LATITUDE = 0
-    LONGITUDE = 1
-
-    def __init__(self, osmfile):
-        # parse the input file and save its contents in memory
+    # mapping from highway types to max speeds
+    # we do this so there"s always a speed limit for every edge, even if
+    # none is in the OSM data
+    MAX_SPEED_MAP = {
+        "motorway" : 140,
+        "trunk" : 120,
+        "primary" : 100,
+        "secondary" : 80,
+        "tertiary" : 70,
+        "road" : 50,
+        "minor" : 50,
+        "unclassified" : 50,
+        "residential" : 30,
+        "track" : 30,
+        "service" : 20,
+        "path" : 10,
+        "cycleway" : 1,   # >0 to prevent infinite weights
+        "bridleway" : 1,  # >0 to prevent infinite weights
+        "pedestrian" : 1, # >0 to prevent infinite weights
+        "footway" : 1,    # >0 to prevent infinite weights
+    }
+
+    # incremented whenever the way the street network or the node categories
+    # are built changes
+    VERSION = 3
+
+    @staticmethod
+    def parameters(length_formula):
+        # everything besides the OSM file that the built street network and
+        # node categories depend on
+        return (GraphBuilder.VERSION, sorted(GraphBuilder.MAX_SPEED_MAP.items()), length_formula)
+
+    # tags we need to build the street network and find the node categories,
+    # all other tags are dropped while parsing
+    USED_TAGS = ("highway", "maxspeed", "landuse")
+
+    # number of highway ways each process builds the streets for at once
+    WAYS_PER_CHUNK = 4096
+
+    def __init__(self, osmfile, concurrency = 1, length_formula = "haversine"):
+        # parse the input file in two passes, each keeping only what is
+        # needed for the street network and the landuse categories
+
+        # number of processes used for parsing and building
+        self.concurrency = concurrency
+        # "haversine" or the faster, approximate "euclidean"
+        if length_formula not in ("haversine", "euclidean"):
+            raise ValueError("Unknown street length formula: " + str(length_formula))
+        self.length_formula = length_formula
+        # number of way segments the street network was built from
+        self.number_of_segments = 0
 
         # initialize street network
-        self.street_network = StreetNetwork()
+        self.street_network = create_street_network()
 
-        # coord pairs as returned from imposm
-        self.coords = dict()
+        # coordinates of the nodes of the street network only, indexed by
+        # the position stored in coord_indices
+        self.coord_indices = dict()
+        self.coord_longitudes = array("d")
+        self.coord_latitudes = array("d")
 
         # max and min latitude and longitude
         self.bounds = dict()
@@ -50,10 +117,22 @@ class GraphBuilder(object):
         self.bounds["min_lon"] = 9999
         self.bounds["max_lon"] = -9999
 
-        # active copy of OSM data indexed by OSM id
+        # relevant OSM data indexed by OSM id: all relations (they are few and
+        # may contain each other), highway and landuse ways as well as ways
+        # that are part of a relation
         self.all_osm_relations = dict()
         self.all_osm_ways = dict()
-        self.all_osm_nodes = dict()
+
+        # ids of ways that are relation members, known after the first pass
+        # and kept only until they are found
+        self.relation_member_ways = set()
+
+        # index of the elements tagged with one of the landuse categories,
+        # filled while parsing: (category, element type, OSM id)
+        self.landuse_elements = []
+        # all nodes of a relation including those of its member ways and
+        # relations, filled on demand
+        self.relation_nodes_cache = dict()
 
         # nodes with specific landuse tags
         self.residential_nodes = set()
@@ -66,169 +145,285 @@ class GraphBuilder(object):
         self.connected_commercial_nodes = set()
 
         # mapping from highway types to max speeds
-        # we do this so there"s always a speed limit for every edge, even if
-        # none is in the OSM data
-        self.max_speed_map = dict()
-        self.max_speed_map["motorway"] = 140
-        self.max_speed_map["trunk"] = 120
-        self.max_speed_map["primary"] = 100
-        self.max_speed_map["secondary"] = 80
-        self.max_speed_map["tertiary"] = 70
-        self.max_speed_map["road"] = 50
-        self.max_speed_map["minor"] = 50
-        self.max_speed_map["unclassified"] = 50
-        self.max_speed_map["residential"] = 30
-        self.max_speed_map["track"] = 30
-        self.max_speed_map["service"] = 20
-        self.max_speed_map["path"] = 10
-        self.max_speed_map["cycleway"] = 1   # >0 to prevent infinite weights
-        self.max_speed_map["bridleway"] = 1  # >0 to prevent infinite weights
-        self.max_speed_map["pedestrian"] = 1 # >0 to prevent infinite weights
-        self.max_speed_map["footway"] = 1    # >0 to prevent infinite weights
-
-        p = OSMParser(concurrency = 1,
-                      coords_callback = self.coords_callback,
-                      nodes_callback = self.nodes_callback,
+        self.max_speed_map = dict(GraphBuilder.MAX_SPEED_MAP)
+
+        # seconds spent in each stage of building
+        self.stage_timings = dict()
+
+        start = time()
+        # first pass: ways and relations, which tell which node coordinates
+        # and which other ways are needed
+        p = OSMParser(concurrency = concurrency,
                       ways_callback = self.ways_callback,
                       relations_callback = self.relations_callback)
         p.parse(osmfile)
+        self.index_street_nodes()
+        self.relation_member_ways.difference_update(self.all_osm_ways)
+
+        # second pass: coordinates, tagged nodes and the ways that are only
+        # part of relations
+        p = OSMParser(concurrency = concurrency,
+                      coords_callback = self.coords_callback,
+                      nodes_callback = self.nodes_callback,
+                      ways_callback = self.member_ways_callback if self.relation_member_ways else None)
+        p.parse(osmfile)
+        self.stage_timings["parsing"] = time() - start
+
+    def index_street_nodes(self):
+        # reserve space for the coordinates of every node on a highway
+        for osmid, tags, refs in self.all_osm_ways.itervalues():
+            if "highway" in tags:
+                for ref in refs:
+                    if ref not in self.coord_indices:
+                        self.coord_indices[ref] = len(self.coord_indices)
+        self.coord_longitudes = array("d", [NAN]) * len(self.coord_indices)
+        self.coord_latitudes = array("d", [NAN]) * len(self.coord_indices)
+
+    def node_coordinates(self, osmid):
+        # longitude and latitude of a node of the street network
+        index = self.coord_indices[osmid]
+        longitude = self.coord_longitudes[index]
+        if longitude != longitude:
+            # not NaN unless the node is missing in the OSM file
+            raise KeyError(osmid)
+        return (longitude, self.coord_latitudes[index])
 
     def build_street_network(self):
+        global _worker_builder
+        start = time()
         # add boundaries to street network
         if 9999 not in self.bounds.values() and -9999 not in self.bounds.values():
             self.street_network.set_bounds(self.bounds["min_lat"], self.bounds["max_lat"], 
                                            self.bounds["min_lon"], self.bounds["max_lon"])
 
-        # construct the actual graph structure from the input data
-        for osmid, tags, refs in self.all_osm_ways.values():
-            if "highway" in tags:
-                if not self.street_network.has_node(refs[0]):
-                    coord = self.coords[refs[0]]
-                    self.street_network.add_node(refs[0], coord[self.LONGITUDE], coord[self.LATITUDE])
-                for i in range(0, len(refs)-1):
-                    if not self.street_network.has_node(refs[i+1]):
-                        coord = self.coords[refs[i+1]]
-                        self.street_network.add_node(refs[i+1], coord[self.LONGITUDE], coord[self.LATITUDE])
-
-                    street = (refs[i], refs[i+1])
-
-                    # calculate street length
-                    length = self.length_haversine(refs[i], refs[i+1])
-
-                    # determine max speed
-                    max_speed = 50
-                    if tags["highway"] in self.max_speed_map.keys():
-                        max_speed = self.max_speed_map[tags["highway"]]
-                    if "maxspeed" in tags:
-                        max_speed_tag = tags["maxspeed"]
-                        if max_speed_tag.isdigit():
-                            max_speed = int(max_speed_tag)
-                        elif max_speed_tag.endswith("mph"):
-                            max_speed = int(max_speed_tag.replace("mph", "").strip(" "))
-                        elif max_speed_tag == "none":
-                            max_speed = 140
-
-                    # add street to street network
-                    if not self.street_network.has_street(street):
-                        self.street_network.add_street(street, length, max_speed)
-
+        # the streets of every way are calculated in chunks of ways, in
+        # parallel if possible, and added to the street network in the order
+        # of the way ids, so that node order and street indices do not
+        # depend on the order of the input or the number of processes
+        self.highway_ways = sorted((way for way in self.all_osm_ways.itervalues() if "highway" in way[1]), key = itemgetter(0))
+        chunks = [(start_index, min(start_index + GraphBuilder.WAYS_PER_CHUNK, len(self.highway_ways)))
+                  for start_index in xrange(0, len(self.highway_ways), GraphBuilder.WAYS_PER_CHUNK)]
+        if self.concurrency > 1 and len(chunks) > 1:
+            # the worker processes get this builder when they are forked
+            _worker_builder = self
+            pool = Pool(self.concurrency)
+            chunk_streets = pool.imap(_build_streets, chunks)
+        else:
+            pool = None
+            chunk_streets = (self.build_streets(start_index, end_index) for start_index, end_index in chunks)
+
+        # construct the actual graph structure from the streets
+        self.number_of_segments = 0
+        for origins, destinations, lengths, max_speeds in chunk_streets:
+            self.number_of_segments += len(origins)
+            for i in xrange(len(origins)):
+                street = (origins[i], destinations[i])
+                for node in street:
+                    if not self.street_network.has_node(node):
+                        longitude, latitude = self.node_coordinates(node)
+                        self.street_network.add_node(node, longitude, latitude)
+
+                # add street to street network, ways may share streets
+                if not self.street_network.has_street(street):
+                    self.street_network.add_street(street, lengths[i], max_speeds[i])
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+            _worker_builder = None
+        self.highway_ways = None
+
+        self.stage_timings["street_network"] = time() - start
         return self.street_network
 
+    def build_streets(self, start_index, end_index):
+        # returns the end nodes, length and max speed of the streets of the
+        # given range of highway ways as arrays
+        origins = array("l")
+        destinations = array("l")
+        max_speeds = array("d")
+        for osmid, tags, refs in self.highway_ways[start_index:end_index]:
+            origins.extend(refs[:-1])
+            destinations.extend(refs[1:])
+            max_speeds.extend(repeat(self.get_max_speed(tags), len(refs) - 1))
+        return origins, destinations, self.street_lengths(origins, destinations), max_speeds
+
+    def street_lengths(self, origins, destinations):
+        # calculate the lengths of all given streets at once
+        coord_indices = self.coord_indices
+        origin_indices = [coord_indices[node] for node in origins]
+        destination_indices = [coord_indices[node] for node in destinations]
+        lengths = array("d")
+
+        if numpy is not None:
+            longitudes = as_numpy(self.coord_longitudes)
+            latitudes = as_numpy(self.coord_latitudes)
+            origin_indices = numpy.array(origin_indices, dtype = numpy.intp)
+            destination_indices = numpy.array(destination_indices, dtype = numpy.intp)
+            if self.length_formula == "euclidean":
+                # see length_euclidean
+                distances = numpy.sqrt(((latitudes[destination_indices] - latitudes[origin_indices]) * 111.32)**2
+                                       + ((longitudes[destination_indices] - longitudes[origin_indices]) * 66.4)**2) * 1000
+            else:
+                distances = haversines(longitudes[origin_indices], latitudes[origin_indices],
+                                       longitudes[destination_indices], latitudes[destination_indices])
+            lengths.fromstring(distances.astype(numpy.float64).tostring())
+            return lengths
+
+        length_function = self.length_euclidean if self.length_formula == "euclidean" else self.length_haversine
+        for origin, destination in zip(origins, destinations):
+            lengths.append(length_function(origin, destination))
+        return lengths
+
+    def get_max_speed(self, tags):
+        # determine max speed of a highway
+        max_speed = 50
+        if tags["highway"] in self.max_speed_map:
+            max_speed = self.max_speed_map[tags["highway"]]
+        if "maxspeed" in tags:
+            max_speed_tag = tags["maxspeed"]
+            if max_speed_tag.isdigit():
+                max_speed = int(max_speed_tag)
+            elif max_speed_tag.endswith("mph"):
+                max_speed = int(max_speed_tag.replace("mph", "").strip(" "))
+            elif max_speed_tag == "none":
+                max_speed = 140
+        return max_speed
+
     def find_node_categories(self):
-        # collect relevant categories of nodes in their respective sets
-        # TODO there has to be a better way to do this
-        # TODO do this inside class StreetNetwork?
-        for osmid, tags, members in self.all_osm_relations.values():
-            if "landuse" in tags:
-                if tags["landuse"] == "residential":
-                    self.residential_nodes = self.residential_nodes | self.get_all_child_nodes(osmid)
-                if tags["landuse"] == "industrial":
-                    self.industrial_nodes = self.industrial_nodes | self.get_all_child_nodes(osmid)
-                if tags["landuse"] == "commercial":
-                    self.commercial_nodes = self.commercial_nodes | self.get_all_child_nodes(osmid)
-        for osmid, tags, refs in self.all_osm_ways.values():
-            if "landuse" in tags:
-                if tags["landuse"] == "residential":
-                    self.residential_nodes = self.residential_nodes | self.get_all_child_nodes(osmid)
-                if tags["landuse"] == "industrial":
-                    self.industrial_nodes = self.industrial_nodes | self.get_all_child_nodes(osmid)
-                if tags["landuse"] == "commercial":
-                    self.commercial_nodes = self.commercial_nodes | self.get_all_child_nodes(osmid)
-        for osmid, tags, coords in self.all_osm_nodes.values():
-            if "landuse" in tags:
-                if tags["landuse"] == "residential":
-                    self.residential_nodes = self.residential_nodes | self.get_all_child_nodes(osmid)
-                if tags["landuse"] == "industrial":
-                    self.industrial_nodes = self.industrial_nodes | self.get_all_child_nodes(osmid)
-                if tags["landuse"] == "commercial":
-                    self.commercial_nodes = self.commercial_nodes | self.get_all_child_nodes(osmid)
+        # collect relevant categories of nodes in their respective sets,
+        # using the landuse elements found while parsing
+        start = time()
+        category_nodes = { "residential" : self.residential_nodes,
+                           "industrial" : self.industrial_nodes,
+                           "commercial" : self.commercial_nodes }
+        # sorted, because with parallel parsing the elements arrive in any
+        # order, which would change the order of the node sets
+        for landuse, element_type, osmid in sorted(self.landuse_elements):
+            nodes = category_nodes[landuse]
+            if element_type == "node":
+                nodes.add(osmid)
+            elif element_type == "way":
+                nodes.update(self.all_osm_ways[osmid][2])
+            else:
+                nodes.update(self.get_relation_nodes(osmid))
+        self.relation_nodes_cache = dict()
+
         street_network_nodes = set(self.street_network.get_nodes())
         self.connected_residential_nodes = self.residential_nodes & street_network_nodes
         self.connected_industrial_nodes = self.industrial_nodes & street_network_nodes
         self.connected_commercial_nodes = self.commercial_nodes & street_network_nodes
+        self.stage_timings["node_categories"] = time() - start
 
     def coords_callback(self, coords):
+        if not coords:
+            return
+        # the bounds cover the whole file, but only coordinates of nodes on
+        # highways are kept
+        self.bounds["min_lat"] = min(self.bounds["min_lat"], min(lat for osmid, lon, lat in coords))
+        self.bounds["min_lon"] = min(self.bounds["min_lon"], min(lon for osmid, lon, lat in coords))
+        self.bounds["max_lat"] = max(self.bounds["max_lat"], max(lat for osmid, lon, lat in coords))
+        self.bounds["max_lon"] = max(self.bounds["max_lon"], max(lon for osmid, lon, lat in coords))
+        coord_indices = self.coord_indices
         for osmid, lon, lat in coords:
-            self.coords[osmid] = dict([(self.LATITUDE, lat), (self.LONGITUDE, lon)])
-            self.bounds["min_lat"] = min(self.bounds["min_lat"], lat)
-            self.bounds["min_lon"] = min(self.bounds["min_lon"], lon)
-            self.bounds["max_lat"] = max(self.bounds["max_lat"], lat)
-            self.bounds["max_lon"] = max(self.bounds["max_lon"], lon)
+            index = coord_indices.get(osmid)
+            if index is not None:
+                self.coord_longitudes[index] = lon
+                self.coord_latitudes[index] = lat
 
     def nodes_callback(self, nodes):
-        for node in nodes:
-            self.all_osm_nodes[node[0]] = node
+        for osmid, tags, coords in nodes:
+            self.index_landuse("node", osmid, tags)
 
     def ways_callback(self, ways):
-        for way in ways:
-            self.all_osm_ways[way[0]] = way
+        for osmid, tags, refs in ways:
+            if "highway" in tags or "landuse" in tags:
+                self.all_osm_ways[osmid] = (osmid, self.used_tags(tags), refs)
+                self.index_landuse("way", osmid, tags)
+
+    def member_ways_callback(self, ways):
+        for osmid, tags, refs in ways:
+            if osmid in self.relation_member_ways:
+                self.all_osm_ways[osmid] = (osmid, self.used_tags(tags), refs)
 
     def relations_callback(self, relations):
-        for relation in relations:
-            self.all_osm_relations[relation[0]] = relation
-
-    def get_all_child_nodes(self, osmid):
-        # given any OSM id, construct a set of the ids of all descendant nodes
-        if osmid in self.all_osm_nodes.keys():
-            return set([osmid])
-        if osmid in self.all_osm_relations.keys():
-            children = set()
-            for osmid, osmtype, role in self.all_osm_relations[osmid][2]:
-                children = children | self.get_all_child_nodes(osmid)
-            return children
-        if osmid in self.all_osm_ways.keys():
-            children = set()
-            for ref in self.all_osm_ways[osmid][2]:
-                children.add(ref)
-            return children
-        return set()
+        for osmid, tags, members in relations:
+            self.all_osm_relations[osmid] = (osmid, self.used_tags(tags), members)
+            self.index_landuse("relation", osmid, tags)
+            for member, member_type, role in members:
+                if member_type == "way":
+                    self.relation_member_ways.add(member)
+
+    def used_tags(self, tags):
+        return dict((key, value) for key, value in tags.iteritems() if key in GraphBuilder.USED_TAGS)
+
+    def index_landuse(self, element_type, osmid, tags):
+        if tags.get("landuse") in ("residential", "industrial", "commercial"):
+            self.landuse_elements.append((tags["landuse"], element_type, osmid))
+
+    def get_relation_nodes(self, osmid):
+        # given a relation id, return the set of ids of all descendant nodes
+        return self._collect_relation_nodes(osmid, dict())[0]
+
+    def _collect_relation_nodes(self, osmid, in_progress):
+        # in_progress maps the relations currently being collected to their
+        # depth. Besides the nodes, this returns the lowest depth of such a
+        # relation that was met again (i.e. the start of a cycle), or None.
+        nodes = self.relation_nodes_cache.get(osmid)
+        if nodes is not None:
+            return nodes, None
+        if osmid in in_progress:
+            # the nodes of this relation are already being collected
+            return set(), in_progress[osmid]
+        if osmid not in self.all_osm_relations:
+            # relation outside of the OSM file
+            return set(), None
+
+        depth = len(in_progress)
+        in_progress[osmid] = depth
+        nodes = set()
+        cycle_depth = None
+        for member, member_type, role in self.all_osm_relations[osmid][2]:
+            if member_type == "node":
+                nodes.add(member)
+            elif member_type == "way":
+                if member in self.all_osm_ways:
+                    nodes.update(self.all_osm_ways[member][2])
+            elif member_type == "relation":
+                member_nodes, member_cycle_depth = self._collect_relation_nodes(member, in_progress)
+                nodes.update(member_nodes)
+                if member_cycle_depth is not None and (cycle_depth is None or member_cycle_depth < cycle_depth):
+                    cycle_depth = member_cycle_depth
+        del in_progress[osmid]
+
+        if cycle_depth is not None and cycle_depth >= depth:
+            # all cycles found lead back to this relation, so its nodes are
+            # complete
+            cycle_depth = None
+        if cycle_depth is None:
+            # nodes of relations inside a cycle through a relation further up
+            # are incomplete and not remembered
+            self.relation_nodes_cache[osmid] = nodes
+        return nodes, cycle_depth
 
     def length_euclidean(self, id1, id2):
         # calculate distance on a 2D plane assuming latitude and longitude
         # form a planar uniform coordinate system (obviously not 100% accurate)
-        p1 = self.coords[id1]
-        p2 = self.coords[id2]
+        longitude1, latitude1 = self.node_coordinates(id1)
+        longitude2, latitude2 = self.node_coordinates(id2)
         # assuming distance between to degrees of latitude to be approx.
         # 66.4km as is the case for Hamburg, and distance between two
         # degrees of longitude is always 111.32km
-        dist = sqrt( ((p2[self.LATITUDE]-p1[self.LATITUDE])*111.32)**2
-                     + ((p2[self.LONGITUDE]-p1[self.LONGITUDE])*66.4)**2 )
+        dist = sqrt( ((latitude2-latitude1)*111.32)**2
+                     + ((longitude2-longitude1)*66.4)**2 )
         return dist*1000 # return distance in m
 
     def length_haversine(self, id1, id2):
         # calculate distance using the haversine formula, which incorporates
         # earth curvature
-        # see http://en.wikipedia.org/wiki/Haversine_formula
-        lat1 = self.coords[id1][self.LATITUDE]
-        lon1 = self.coords[id1][self.LONGITUDE]
-        lat2 = self.coords[id2][self.LATITUDE]
-        lon2 = self.coords[id2][self.LONGITUDE]
-        lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-        dlon = lon2 - lon1
-        dlat = lat2 - lat1
-        a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-        c = 2 * asin(sqrt(a))
-        return 6367000 * c # return distance in m
+        longitude1, latitude1 = self.node_coordinates(id1)
+        longitude2, latitude2 = self.node_coordinates(id2)
+        return haversine(longitude1, latitude1, longitude2, latitude2)
 
 if __name__ == "__main__":
     # instantiate counter and parser and start parsing
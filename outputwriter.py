@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# outputwriter.py
+# Copyright 2012 Julian Fietkau <http://www.julian-fietkau.de/>,
+#                Joachim Nitschke
+#
+# This file is part of Streets4MPI.
+#
+# Streets4MPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Streets4MPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from time import time
+from threading import Thread
+from Queue import Queue
+from collections import deque
+
+# This class runs output jobs (functions and their arguments) one after the
+# other in a background thread. The jobs own their arguments, so the caller
+# must not change them afterwards. At most queue_size jobs wait at a time;
+# if the disk falls behind, adding another one blocks until there is room.
+class OutputWriter(object):
+
+    def __init__(self, queue_size = 2):
+        self._queue = Queue(queue_size)
+        # description, seconds from adding to finishing and result of every
+        # finished job that has not been popped yet
+        self._finished = deque()
+        self._error = None
+        self._thread = Thread(target = self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def put(self, description, function, *arguments):
+        # returns the number of seconds spent waiting for room in the queue
+        if self._error is not None:
+            raise self._error
+        start = time()
+        self._queue.put((description, start, function, arguments))
+        return time() - start
+
+
+    def pop_finished(self):
+        finished = []
+        while self._finished:
+            finished.append(self._finished.popleft())
+        return finished
+
+
+    def flush(self):
+        # waits until all jobs added so far are done
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+
+    def close(self):
+        # waits until all jobs are done
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                break
+            try:
+                if self._error is not None:
+                    # the caller gets the error the next time it adds a job
+                    continue
+                description, start, function, arguments = job
+                try:
+                    result = function(*arguments)
+                except Exception as error:
+                    self._error = error
+                    continue
+                self._finished.append((description, time() - start, result))
+            finally:
+                self._queue.task_done()
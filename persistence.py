@@ -27,9 +27,9 @@ import array
 # This function serializes and compresses an object
 def persist_serialize(data, compress = True):
     if compress:
-        return zlib.compress(cPickle.dumps(data))
+        return zlib.compress(cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL))
     else:
-        return cPickle.dumps(data)
+        return cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
 
 # This function deserializes and decompresses an object
 def persist_deserialize(data, compressed = True):
@@ -40,17 +40,23 @@ def persist_deserialize(data, compressed = True):
 
 # This function saves a data structure to a file
 def persist_write(filename, data, compress = True, is_array = False):
-    file = open(filename, "w")
     if is_array:
         data = zlib.compress(data.tostring())
     else:
         data = persist_serialize(data, compress)
-    file.write(data)
+    file = open(filename, "wb")
+    try:
+        file.write(data)
+    finally:
+        file.close()
 
 # This function reads a data structure from a file
 def persist_read(filename, compressed = True, is_array = False):
-    file = open(filename, "r")
-    data = file.read()
+    file = open(filename, "rb")
+    try:
+        data = file.read()
+    finally:
+        file.close()
     if is_array:
         result = array.array("I")
         result.fromstring(zlib.decompress(data))
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# routeplanning.py
+# Copyright 2012 Julian Fietkau <http://www.julian-fietkau.de/>,
+#                Joachim Nitschke
+#
+# This file is part of Streets4MPI.
+#
+# Streets4MPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Streets4MPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from array import array
+from os import path, rename, getpid
+from zlib import crc32
+
+from persistence import persist_write, persist_read
+
+INFINITY = float("inf")
+
+# This class answers shortest path queries with a customizable contraction
+# hierarchy. The expensive part, ordering the nodes and adding shortcuts, only
+# depends on the topology of the street network and is done once (or read from
+# disk). Whenever the driving times change, a cheap customization pass assigns
+# weights to all shortcuts, after which every origin-goal query only looks at
+# the ancestors of both nodes in the elimination tree.
+class CustomizableRoutePlanner(object):
+
+    FORMAT_VERSION = 1
+    # networks up to this number of nodes are not split any further
+    DISSECTION_CELL_SIZE = 16
+
+    def __init__(self, fallback):
+        # engine used for queries without goals, which need the full tree
+        self.fallback = fallback
+        self.topology = None
+        # weights of the upward arcs and the two lower arcs that make up each
+        # shortcut (-1 if the arc is a plain street)
+        self.weights = None
+        self.shortcut_first = None
+        self.shortcut_second = None
+        self._customized_key = None
+
+
+    def prepare(self, street_network, filename = None):
+        # read the preprocessed topology from disk if it fits the street
+        # network, otherwise calculate it and store it for the next run
+        signature = self._signature(street_network)
+        if filename is not None and path.exists(filename):
+            topology = persist_read(filename)
+            if topology.get("version") == CustomizableRoutePlanner.FORMAT_VERSION and topology.get("signature") == signature:
+                self.topology = topology
+                self._customized_key = None
+                return False
+        self.topology = self._preprocess(street_network)
+        self.topology["version"] = CustomizableRoutePlanner.FORMAT_VERSION
+        self.topology["signature"] = signature
+        self._customized_key = None
+        if filename is not None:
+            # write to a temporary file first so that other processes never
+            # read a half-written file
+            temporary_filename = filename + "." + str(getpid())
+            persist_write(temporary_filename, self.topology)
+            rename(temporary_filename, filename)
+        return True
+
+
+    def calculate(self, street_network, origin, goals = None):
+        if goals is None:
+            return self.fallback.calculate(street_network, origin)
+        if self.topology is None or self.topology["signature"] != self._signature(street_network):
+            self.prepare(street_network)
+        self.customize(street_network)
+
+        predecessors = array("i", [-1]) * (len(street_network.adjacency_offsets) - 1)
+        predecessor_streets = array("i", [-1]) * len(predecessors)
+        order = [origin]
+        in_tree = set(order)
+        forward_distances, forward_arcs = self._upward_search(origin)
+
+        for goal in goals:
+            if goal in in_tree:
+                continue
+            backward_distances, backward_arcs = self._upward_search(goal)
+            meeting_node = None
+            best_distance = INFINITY
+            for node, distance in backward_distances.iteritems():
+                if node in forward_distances and forward_distances[node] + distance < best_distance:
+                    best_distance = forward_distances[node] + distance
+                    meeting_node = node
+            if meeting_node is None:
+                # goal is not reachable
+                continue
+
+            # hook the unpacked path into the tree, keeping the predecessors
+            # of nodes that are already part of it
+            previous = origin
+            for node, street in self._unpack_path(origin, goal, meeting_node, forward_arcs, backward_arcs):
+                if node not in in_tree:
+                    predecessors[node] = previous
+                    predecessor_streets[node] = street
+                    order.append(node)
+                    in_tree.add(node)
+                previous = node
+
+        return predecessors, predecessor_streets, order
+
+
+    def customize(self, street_network):
+        key = (id(street_network), street_network.driving_time_version)
+        if key == self._customized_key:
+            return
+
+        topology = self.topology
+        driving_times = street_network.street_driving_times
+        arc_streets = topology["arc_streets"]
+        number_of_arcs = len(arc_streets)
+
+        weights = array("d", [INFINITY]) * number_of_arcs
+        shortcut_first = array("i", [-1]) * number_of_arcs
+        shortcut_second = array("i", [-1]) * number_of_arcs
+        for arc in xrange(number_of_arcs):
+            street = arc_streets[arc]
+            if street >= 0:
+                weights[arc] = driving_times[street]
+
+        # triangles are ordered by the rank of their lowest node, so the two
+        # lower arcs already carry their final weight when they are used
+        triangles = topology["triangles"]
+        for i in xrange(0, len(triangles), 3):
+            first = triangles[i]
+            second = triangles[i + 1]
+            upper = triangles[i + 2]
+            alternative = weights[first] + weights[second]
+            if alternative < weights[upper]:
+                weights[upper] = alternative
+                shortcut_first[upper] = first
+                shortcut_second[upper] = second
+
+        self.weights = weights
+        self.shortcut_first = shortcut_first
+        self.shortcut_second = shortcut_second
+        self._customized_key = key
+
+
+    def _upward_search(self, source):
+        # all nodes reachable via upward arcs are ancestors in the elimination
+        # tree, so visiting the ancestors bottom-up settles them in order
+        topology = self.topology
+        offsets = topology["up_offsets"]
+        targets = topology["up_targets"]
+        parents = topology["parents"]
+        weights = self.weights
+
+        distances = {source: 0}
+        arcs = dict()
+        node = source
+        while node >= 0:
+            distance = distances.get(node)
+            if distance is not None:
+                for arc in xrange(offsets[node], offsets[node + 1]):
+                    target = targets[arc]
+                    alternative = distance + weights[arc]
+                    if alternative < distances.get(target, INFINITY):
+                        distances[target] = alternative
+                        arcs[target] = arc
+            node = parents[node]
+
+        return distances, arcs
+
+
+    def _unpack_path(self, origin, goal, meeting_node, forward_arcs, backward_arcs):
+        tails = self.topology["arc_tails"]
+
+        # upward arcs from the origin to the meeting node
+        upward = []
+        node = meeting_node
+        while node != origin:
+            arc = forward_arcs[node]
+            upward.append(arc)
+            node = tails[arc]
+        upward.reverse()
+
+        # downward arcs from the meeting node to the goal
+        downward = []
+        node = meeting_node
+        while node != goal:
+            arc = backward_arcs[node]
+            downward.append(arc)
+            node = tails[arc]
+
+        nodes = []
+        for arc in upward:
+            self._unpack_arc(arc, True, nodes)
+        for arc in downward:
+            self._unpack_arc(arc, False, nodes)
+        return nodes
+
+
+    def _unpack_arc(self, arc, upward, nodes):
+        # append the nodes of an arc after its start node together with the
+        # street leading to them, replacing shortcuts by the two arcs they
+        # were made of
+        tails = self.topology["arc_tails"]
+        targets = self.topology["up_targets"]
+        stack = [(arc, upward)]
+        while stack:
+            arc, upward = stack.pop()
+            first = self.shortcut_first[arc]
+            if first < 0:
+                nodes.append((targets[arc] if upward else tails[arc], self.topology["arc_streets"][arc]))
+                continue
+            second = self.shortcut_second[arc]
+            # first leads from the middle node to the tail of arc, second from
+            # the middle node to its head
+            if upward:
+                stack.append((second, True))
+                stack.append((first, False))
+            else:
+                stack.append((first, True))
+                stack.append((second, False))
+
+
+    def _signature(self, street_network):
+        return (len(street_network.node_ids), street_network.street_index,
+                crc32(street_network.street_destinations.tostring(), crc32(street_network.street_origins.tostring())))
+
+
+    def _preprocess(self, street_network):
+        offsets, adjacent_nodes, adjacent_streets = street_network.get_adjacency()
+        number_of_nodes = len(offsets) - 1
+
+        nodes_by_rank = self._nested_dissection_order(street_network, offsets, adjacent_nodes)
+        ranks = array("i", [-1]) * number_of_nodes
+        for rank, node in enumerate(nodes_by_rank):
+            ranks[node] = rank
+
+        # eliminate the nodes in that order, connecting the remaining
+        # neighbors of every eliminated node with each other
+        neighbors = [set(adjacent_nodes[offsets[node]:offsets[node + 1]]) for node in xrange(number_of_nodes)]
+        upper_neighbors = [None] * number_of_nodes
+        for node in nodes_by_rank:
+            upper = neighbors[node]
+            upper_neighbors[node] = upper
+            neighbors[node] = None
+            for neighbor in upper:
+                neighbor_set = neighbors[neighbor]
+                neighbor_set.discard(node)
+                neighbor_set.update(upper)
+                neighbor_set.discard(neighbor)
+        del neighbors
+
+        # upward arcs sorted by the rank of their head
+        up_offsets = array("i", [0]) * (number_of_nodes + 1)
+        up_targets = array("i")
+        arc_tails = array("i")
+        arc_streets = array("i")
+        arc_indices = dict()
+        for node in xrange(number_of_nodes):
+            up_offsets[node] = len(up_targets)
+            street_by_neighbor = dict(zip(adjacent_nodes[offsets[node]:offsets[node + 1]], adjacent_streets[offsets[node]:offsets[node + 1]]))
+            for target in sorted(upper_neighbors[node], key = ranks.__getitem__):
+                arc_indices[(node, target)] = len(up_targets)
+                up_targets.append(target)
+                arc_tails.append(node)
+                arc_streets.append(street_by_neighbor.get(target, -1))
+        up_offsets[number_of_nodes] = len(up_targets)
+
+        # the parent in the elimination tree is the lowest upper neighbor
+        parents = array("i", [-1]) * number_of_nodes
+        for node in xrange(number_of_nodes):
+            if up_offsets[node] < up_offsets[node + 1]:
+                parents[node] = up_targets[up_offsets[node]]
+
+        # every pair of upper neighbors of a node forms a lower triangle with
+        # the arc between them, which exists because of the fill-in above
+        triangles = array("i")
+        for node in nodes_by_rank:
+            for i in xrange(up_offsets[node], up_offsets[node + 1]):
+                lower_target = up_targets[i]
+                for j in xrange(i + 1, up_offsets[node + 1]):
+                    triangles.append(i)
+                    triangles.append(j)
+                    triangles.append(arc_indices[(lower_target, up_targets[j])])
+
+        return {
+            "ranks" : ranks,
+            "up_offsets" : up_offsets,
+            "up_targets" : up_targets,
+            "arc_tails" : arc_tails,
+            "arc_streets" : arc_streets,
+            "parents" : parents,
+            "triangles" : triangles
+        }
+
+
+    def _nested_dissection_order(self, street_network, offsets, adjacent_nodes):
+        # split the network recursively at the median longitude or latitude;
+        # the nodes of one side that touch the other side form a separator
+        # which is ordered after both sides, so that few shortcuts cross it
+        longitudes = street_network.node_longitudes
+        latitudes = street_network.node_latitudes
+        order = []
+        # stack of (nodes, is_separator)
+        stack = [(range(len(offsets) - 1), False)]
+        while stack:
+            nodes, is_separator = stack.pop()
+            if is_separator:
+                order.extend(nodes)
+                continue
+            if len(nodes) <= CustomizableRoutePlanner.DISSECTION_CELL_SIZE:
+                # low degree nodes first inside a cell keeps the fill-in
+                # small (the order is reversed below)
+                order.extend(sorted(nodes, key = lambda node: offsets[node + 1] - offsets[node], reverse = True))
+                continue
+            longitude_span = max(longitudes[node] for node in nodes) - min(longitudes[node] for node in nodes)
+            latitude_span = max(latitudes[node] for node in nodes) - min(latitudes[node] for node in nodes)
+            coordinates = longitudes if longitude_span * 0.6 > latitude_span else latitudes
+            nodes = sorted(nodes, key = coordinates.__getitem__)
+            half = len(nodes) / 2
+            second_part = set(nodes[half:])
+            first_part = []
+            separator = []
+            for node in nodes[:half]:
+                for i in xrange(offsets[node], offsets[node + 1]):
+                    if adjacent_nodes[i] in second_part:
+                        separator.append(node)
+                        break
+                else:
+                    first_part.append(node)
+            # nodes are collected from the highest rank downwards
+            stack.append((list(second_part), False))
+            stack.append((first_part, False))
+            stack.append((separator, True))
+        order.reverse()
+
+        return order
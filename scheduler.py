@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# scheduler.py
+# Copyright 2012 Julian Fietkau <http://www.julian-fietkau.de/>,
+#                Joachim Nitschke
+#
+# This file is part of Streets4MPI.
+#
+# Streets4MPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Streets4MPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from array import array
+
+from mpi4py import MPI
+
+# This class hands out batches of origins to the processes on demand. All
+# processes know all trips; a counter in a one-sided MPI window on the first
+# process tells which batch is next. Origins are given as (trip table,
+# origin) pairs, and every batch only holds origins of one trip table, so
+# that a process only has to change the driving times for another traffic
+# jam tolerance between batches. Batches are formed from the origin costs
+# measured in the previous step, most expensive origins first, so that the
+# small batches at the end even out the remaining differences.
+class OriginScheduler(object):
+
+    def __init__(self, communicator, origins, batches_per_process = 4):
+        self.communicator = communicator
+        self.origins = sorted(origins)
+        self.origin_positions = dict((origin, position) for position, origin in enumerate(self.origins))
+        self.number_of_batches = max(1, min(len(self.origins), batches_per_process * communicator.Get_size()))
+        # until the first step has been measured, all origins cost the same
+        self.costs = array("d", [1.0]) * len(self.origins)
+        self.batches = self._make_batches()
+
+        # shared batch counter, only the first process provides memory for it
+        self._counter_size = MPI.LONG.Get_size()
+        self.window = MPI.Win.Allocate(self._counter_size if communicator.Get_rank() == 0 else 0,
+                                       self._counter_size, comm = communicator)
+        self._reset_counter()
+        communicator.Barrier()
+
+    def origins_for_step(self):
+        # generator over the origins this process should calculate, fetches
+        # the next batch whenever the previous one is done
+        increment = array("l", [1])
+        batch = array("l", [0])
+        while True:
+            self.window.Lock(0)
+            self.window.Fetch_and_op([increment, MPI.LONG], [batch, MPI.LONG], 0, 0, MPI.SUM)
+            self.window.Unlock(0)
+            if batch[0] >= len(self.batches):
+                return
+            for origin in self.batches[batch[0]]:
+                yield origin
+
+    def end_step(self, origin_costs):
+        # must be called by all processes once they are out of origins
+        self.communicator.Barrier()
+        self._reset_counter()
+
+        # every origin has been calculated by exactly one process
+        local_costs = array("d", [0.0]) * len(self.origins)
+        for origin, cost in origin_costs.iteritems():
+            local_costs[self.origin_positions[origin]] = cost
+        self.communicator.Allreduce(local_costs, self.costs, MPI.SUM)
+        self.batches = self._make_batches()
+
+    def restore_costs(self, costs):
+        # costs measured before, e.g. read from a checkpoint
+        self.costs[:] = array("d", costs)
+        self.batches = self._make_batches()
+
+    def close(self):
+        self.window.Free()
+
+    def _reset_counter(self):
+        if self.communicator.Get_rank() == 0:
+            self.window.Lock(0)
+            self.window.Put([array("l", [0]), MPI.LONG], 0)
+            self.window.Unlock(0)
+
+    def _make_batches(self):
+        # cut the origins of every trip table, most expensive first, into
+        # batches of roughly equal cost; the unfinished batches of all trip
+        # tables follow at the end, most expensive first. The result is the
+        # same on every process.
+        positions = sorted(range(len(self.origins)), key = lambda position: (-self.costs[position], position))
+        target_cost = sum(self.costs) / self.number_of_batches
+        batches = []
+        # trip table -> unfinished batch and its cost
+        open_batches = dict()
+        for position in positions:
+            table = self.origins[position][0]
+            batch, batch_cost = open_batches.get(table, ([], 0))
+            batch.append(self.origins[position])
+            batch_cost += self.costs[position]
+            if batch_cost >= target_cost:
+                batches.append(batch)
+                del open_batches[table]
+            else:
+                open_batches[table] = (batch, batch_cost)
+        for table, (batch, batch_cost) in sorted(open_batches.iteritems(), key = lambda item: (-item[1][1], item[0])):
+            batches.append(batch)
+        return batches
@@ -27,11 +27,72 @@ settings = {
     "logging" : "stdout",
     "persist_traffic_load" : True,
     "random_seed" : 3756917, # set to None to use system time
+    # street networks built from OSM files are kept here so that the file
+    # does not have to be parsed again (None to always parse it)
+    "street_network_cache_directory" : "cache",
+    # number of processes used to parse the OSM file and build the street
+    # network (None: all cores of the machine when running a single process,
+    # otherwise 1)
+    "osm_parser_concurrency" : None,
+    # street lengths are calculated from the coordinates with the "haversine"
+    # formula or with a faster "euclidean" approximation (only accurate near
+    # Hamburg's latitude, not suitable for the "astar" search)
+    "street_length_formula" : "haversine",
+    # merge chains of streets through nodes with only two neighbors into
+    # single streets (fewer, longer streets to route over and to exchange)
+    "simplify_street_network" : False,
+    # "pygraph" or "array" (compact typed arrays, much smaller in memory)
+    "street_network_backend" : "pygraph",
+    # shortest path engine for the "array" backend: "heap" (pure Python),
+    # "scipy" (needs NumPy and SciPy), "cch" (customizable contraction
+    # hierarchy), "incremental" (see below) or "auto" (scipy if available)
+    "shortest_path_engine" : "auto",
+    # the "incremental" engine keeps every origin's tree and repairs it when
+    # driving times change by more than this share (otherwise they are
+    # ignored), unless more than the fallback share of streets changed
+    "incremental_tolerance" : 0.01,
+    "incremental_fallback" : 0.1,
+    # "full" tree from every origin, stop once all "goals" of the origin are
+    # reached, or additionally guide the search by distance ("astar")
+    "shortest_path_search" : "full",
+    # how processes get the street network: "none" (every process reads the
+    # OpenStreetMap data), "broadcast" (only the first process reads it and
+    # sends a copy to the others) or "shared" (like "broadcast", but processes
+    # on the same node share one copy of the topology, needs NumPy)
+    "street_network_distribution" : "broadcast",
+
+    # every this many steps, all processes write their state to files in
+    # the checkpoint directory (None: never); "python streets4mpi.py
+    # --resume" continues from the last complete checkpoint
+    "checkpoint_interval" : None,
+    "checkpoint_directory" : "checkpoints",
+    # traffic loads are compressed with this codec ("none" keeps them
+    # readable in place, "zlib" or "bz2") at this level (None: default) and
+    # written in the background; the simulation waits once more than this
+    # many outputs are waiting to be written
+    "output_codec" : "none",
+    "output_compression_level" : None,
+    "output_queue_size" : 2,
 
     # simulation settings
     "max_simulation_steps" : 10,
     "number_of_residents" : 100,
     "use_residential_origins" : False,
+    # residents starting in the same square grid cell of this size share the
+    # origin closest to the centroid of the cell's origins, bounding the
+    # shortest path trees per step (None: no clustering)
+    "origin_cell_size" : None, # m
+    # how much more likely nodes in "residential", "commercial" and
+    # "industrial" areas are drawn as origins and goals than other nodes,
+    # e.g. { "residential" : 10 } (None: all nodes are equally likely)
+    "landuse_weights" : None,
+    # "static": every process simulates its own share of the residents,
+    # "dynamic": processes take batches of origins from a shared queue
+    "origin_scheduling" : "static",
+    "origin_batches_per_process" : 4,
+    # how processes sum up their traffic loads: "dense" (all streets),
+    # "sparse" (only streets with traffic) or "auto" (fewer bytes, needs NumPy)
+    "traffic_load_exchange" : "auto",
     # period over which the traffic is distributed (24h = the hole day)
     "traffic_period_duration" : 8, # h
     "car_length" : 4, # m
@@ -40,6 +101,16 @@ settings = {
     # see http://www.bense-jessen.de/Infos/Page10430/page10430.html
     "braking_deceleration" : 7.5, # m/s²
     "steps_between_street_construction" : 10,
+    # share of the streets with the lowest traffic load that are slowed down
+    # and of those with the highest load that are sped up in road construction
+    "road_construction_decrease_share" : 0.15,
+    "road_construction_increase_share" : 0.05,
+    "road_construction_speed_change" : 20, # km/h
+    # once the traffic load changes by less than this share from one step to
+    # the next (None: never), "stop" the simulation or skip to the next
+    # road "construction"
+    "convergence_threshold" : None,
+    "convergence_action" : "stop",
     "trip_volume" : 1
 }
 
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# shortestpaths.py
+# Copyright 2012 Julian Fietkau <http://www.julian-fietkau.de/>,
+#                Joachim Nitschke
+#
+# This file is part of Streets4MPI.
+#
+# Streets4MPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Streets4MPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from array import array
+from heapq import heappush, heappop
+from math import sqrt, radians, sin, cos, asin
+
+try:
+    import numpy
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra
+except ImportError:
+    numpy = None
+
+from routeplanning import CustomizableRoutePlanner
+from dynamicpaths import DynamicDijkstra
+from settings import settings
+from utils import EARTH_RADIUS
+
+INFINITY = float("inf")
+
+# This class computes shortest path trees with Dijkstra's algorithm using a
+# binary heap directly on the flat arrays of an ArrayStreetNetwork. Searches:
+# "full"  - settle every reachable node
+# "goals" - stop as soon as all given goals are settled
+# "astar" - like "goals", but guided by a haversine lower bound on the
+#           remaining driving time (only valid if street lengths are at least
+#           the great-circle distance between their end nodes, as built by
+#           GraphBuilder)
+class HeapDijkstra(object):
+
+    def __init__(self, search = "full"):
+        self.search = search
+
+    def calculate(self, street_network, origin, goals = None):
+        return self._search(street_network, origin, goals, street_network.street_driving_times)[1:]
+
+    def calculate_tree(self, street_network, origin, driving_times, driving_time_key = None):
+        # full tree for the given driving times instead of the current ones,
+        # returns the distances of all nodes as well (see dynamicpaths.py)
+        return self._search(street_network, origin, None, driving_times)[:3]
+
+    def _search(self, street_network, origin, goals, driving_times):
+        offsets, neighbors, streets = street_network.get_adjacency()
+        number_of_nodes = len(offsets) - 1
+
+        remaining_goals = None
+        lower_bound = None
+        if goals is not None and self.search != "full":
+            remaining_goals = set(goals)
+            if self.search == "astar" and len(remaining_goals) > 0:
+                lower_bound = self._lower_bound(street_network, remaining_goals)
+
+        distances = array("d", [INFINITY]) * number_of_nodes
+        predecessors = array("i", [-1]) * number_of_nodes
+        predecessor_streets = array("i", [-1]) * number_of_nodes
+        finished = bytearray(number_of_nodes)
+        # settled nodes in the order they were settled
+        order = []
+        distances[origin] = 0
+        queue = [(0, origin)]
+
+        while queue:
+            node = heappop(queue)[1]
+            if finished[node]:
+                continue
+            finished[node] = 1
+            order.append(node)
+            if remaining_goals is not None:
+                remaining_goals.discard(node)
+                if len(remaining_goals) == 0:
+                    break
+            distance = distances[node]
+            for i in xrange(offsets[node], offsets[node + 1]):
+                neighbor = neighbors[i]
+                if finished[neighbor]:
+                    continue
+                alternative = distance + driving_times[streets[i]]
+                if alternative < distances[neighbor]:
+                    distances[neighbor] = alternative
+                    predecessors[neighbor] = node
+                    predecessor_streets[neighbor] = streets[i]
+                    if lower_bound is None:
+                        heappush(queue, (alternative, neighbor))
+                    else:
+                        heappush(queue, (alternative + lower_bound(neighbor), neighbor))
+
+        return distances, predecessors, predecessor_streets, order
+
+    def _lower_bound(self, street_network, goals):
+        # no street can be driven faster than the highest speed limit, so the
+        # great-circle distance to the closest goal divided by it can never
+        # overestimate the remaining driving time
+        longitudes = street_network.node_longitudes
+        latitudes = street_network.node_latitudes
+        goal_coordinates = [(radians(longitudes[goal]), radians(latitudes[goal]), cos(radians(latitudes[goal]))) for goal in goals]
+        # leave some slack for rounding errors in the street lengths
+        factor = 0.999 * 2 * EARTH_RADIUS / street_network.get_max_speed()
+        bounds = dict()
+
+        def lower_bound(node):
+            # haversine formula, see utils.py
+            if node not in bounds:
+                longitude = radians(longitudes[node])
+                latitude = radians(latitudes[node])
+                latitude_cosine = cos(latitude)
+                bounds[node] = factor * asin(sqrt(min([sin((goal_latitude - latitude) / 2) ** 2 + latitude_cosine * goal_latitude_cosine * sin((goal_longitude - longitude) / 2) ** 2
+                                                       for goal_longitude, goal_latitude, goal_latitude_cosine in goal_coordinates])))
+            return bounds[node]
+
+        return lower_bound
+
+
+# This class computes shortest path trees with the compiled Dijkstra
+# implementation from scipy.sparse.csgraph
+class ScipyDijkstra(object):
+
+    def __init__(self):
+        if numpy is None:
+            raise ImportError("The scipy shortest path engine needs NumPy and SciPy")
+        # sparse matrix of the driving times, rebuilt whenever they change
+        self._matrix = None
+        self._matrix_key = None
+        # start node, end node and street of every entry in the adjacency
+        self._arc_tails = None
+        self._arc_heads = None
+        self._arc_streets = None
+
+    def calculate(self, street_network, origin, goals = None):
+        # the compiled search always builds the full tree, which is usually
+        # still faster than stopping early in Python
+        distances, predecessors, predecessor_streets = self.calculate_tree(street_network, origin, street_network.street_driving_times,
+                                                                           street_network.driving_time_version)
+        return predecessors, predecessor_streets, None
+
+    def calculate_tree(self, street_network, origin, driving_times, driving_time_key):
+        # full tree for the given driving times, which must only change
+        # together with driving_time_key; also returns the distances
+        distances, predecessors = dijkstra(self._get_matrix(street_network, driving_times, driving_time_key), directed = True,
+                                           indices = origin, return_predecessors = True)
+        # scipy marks the origin and unreachable nodes with a negative value
+        predecessors[predecessors < 0] = -1
+
+        # the street leading to every node is the adjacency entry that starts
+        # at the predecessor of that node
+        tree_arcs = predecessors[self._arc_heads] == self._arc_tails
+        predecessor_streets = numpy.empty_like(predecessors)
+        predecessor_streets.fill(-1)
+        predecessor_streets[self._arc_heads[tree_arcs]] = self._arc_streets[tree_arcs]
+
+        return distances, predecessors, predecessor_streets
+
+    def _get_matrix(self, street_network, driving_times, driving_time_key):
+        offsets, neighbors, streets = street_network.get_adjacency()
+        key = (id(offsets), len(offsets), driving_time_key)
+        if key != self._matrix_key:
+            driving_times = numpy.frombuffer(driving_times, dtype = numpy.float64)
+            # every street appears twice in the adjacency, once per direction;
+            # explicit zeros are kept as zero-length edges by csgraph
+            weights = driving_times[numpy.frombuffer(streets, dtype = numpy.int32)]
+            number_of_nodes = len(offsets) - 1
+            self._arc_heads = numpy.array(neighbors, dtype = numpy.int32)
+            self._arc_streets = numpy.array(streets, dtype = numpy.int32)
+            offsets = numpy.array(offsets, dtype = numpy.int32)
+            self._arc_tails = numpy.repeat(numpy.arange(number_of_nodes, dtype = numpy.int32), numpy.diff(offsets))
+            self._matrix = csr_matrix((weights, self._arc_heads, offsets), shape = (number_of_nodes, number_of_nodes))
+            self._matrix_key = key
+
+        return self._matrix
+
+
+# This function creates the shortest path engine chosen in the settings
+def create_shortest_path_engine(engine = None, search = None):
+    if engine is None:
+        engine = settings["shortest_path_engine"]
+    if search is None:
+        search = settings["shortest_path_search"]
+    if search not in ("full", "goals", "astar"):
+        raise ValueError("Unknown shortest path search: " + str(search))
+    if engine == "auto":
+        # only the pure Python engine can stop early
+        engine = "heap" if numpy is None or search != "full" else "scipy"
+    if engine == "heap":
+        return HeapDijkstra(search)
+    if engine == "scipy":
+        return ScipyDijkstra()
+    if engine == "cch":
+        return CustomizableRoutePlanner(HeapDijkstra(search))
+    if engine == "incremental":
+        # trees that cannot be repaired are calculated by the fastest engine
+        return DynamicDijkstra(HeapDijkstra() if numpy is None else ScipyDijkstra(),
+                               settings["incremental_tolerance"], settings["incremental_fallback"])
+    raise ValueError("Unknown shortest path engine: " + str(engine))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# simplification.py
+# Copyright 2012 Julian Fietkau <http://www.julian-fietkau.de/>,
+#                Joachim Nitschke
+#
+# This file is part of Streets4MPI.
+#
+# Streets4MPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Streets4MPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from operator import itemgetter
+
+from arraystreetnetwork import ArrayStreetNetwork
+from streetnetwork import create_street_network
+
+# This function returns a copy of the street network in which every chain of
+# streets through nodes with exactly two neighbors is replaced by a single
+# street with the summed length. The nodes in between are only kept as the
+# geometry of that street. Chains are only merged across streets with the
+# same max speed, and protected nodes (e.g. possible origins and goals) always
+# remain part of the network.
+def simplify_street_network(street_network, protected_nodes = frozenset()):
+    streets = sorted(street_network, key = itemgetter(1))
+    neighbors = dict()
+    for street, street_index, length, max_speed in streets:
+        for node, neighbor in (street, reversed(street)):
+            neighbors.setdefault(node, []).append((neighbor, street_index))
+
+    max_speeds = dict((street_index, max_speed) for street, street_index, length, max_speed in streets)
+    def is_chain_node(node):
+        node_neighbors = neighbors.get(node, ())
+        return (len(node_neighbors) == 2 and node not in protected_nodes
+                and node_neighbors[0][0] != node_neighbors[1][0]
+                and max_speeds[node_neighbors[0][1]] == max_speeds[node_neighbors[1][1]])
+
+    simplified = create_street_network("array" if isinstance(street_network, ArrayStreetNetwork) else "pygraph")
+    if street_network.bounds is not None:
+        simplified.set_bounds(street_network.bounds[0][0], street_network.bounds[0][1],
+                              street_network.bounds[1][0], street_network.bounds[1][1])
+    chain_nodes = set(node for node in neighbors if is_chain_node(node))
+    for node in street_network.get_nodes():
+        if node not in chain_nodes:
+            longitude, latitude = street_network.node_coordinates(node)
+            simplified.add_node(node, longitude, latitude)
+
+    lengths = dict((street_index, length) for street, street_index, length, max_speed in streets)
+    used = set()
+
+    # streets between two remaining nodes first, so that they are never
+    # mistaken for a duplicate of a merged chain
+    for street, street_index, length, max_speed in streets:
+        if street[0] not in chain_nodes and street[1] not in chain_nodes:
+            simplified.add_street(street, length, max_speed, street_network.get_street_geometry(street_index))
+            used.add(street_index)
+
+    def follow_chain(start, street_index):
+        # walk from a node along a street until the next remaining node and
+        # return the nodes passed and the streets used on the way
+        passed = []
+        chain_streets = [street_index]
+        node = _other_end(neighbors, start, street_index)
+        while node in chain_nodes and node != start:
+            passed.append(node)
+            for neighbor, next_street_index in neighbors[node]:
+                if next_street_index != street_index:
+                    break
+            street_index = next_street_index
+            chain_streets.append(street_index)
+            node = _other_end(neighbors, node, street_index)
+        return node, passed, chain_streets
+
+    for street, street_index, length, max_speed in streets:
+        if street_index in used:
+            continue
+        if street[0] in chain_nodes and street[1] in chain_nodes:
+            # inner street of a chain, reached from one of its ends
+            continue
+        start = street[0] if street[0] not in chain_nodes else street[1]
+        end, passed, chain_streets = follow_chain(start, street_index)
+        used.update(chain_streets)
+        _add_chain(simplified, street_network, start, end, passed, chain_streets, lengths, max_speed)
+
+    # what is left are closed loops of chain nodes without any remaining node
+    for street, street_index, length, max_speed in streets:
+        if street_index in used:
+            continue
+        start = street[0]
+        longitude, latitude = street_network.node_coordinates(start)
+        simplified.add_node(start, longitude, latitude)
+        end, passed, chain_streets = follow_chain(start, street_index)
+        used.update(chain_streets)
+        _add_chain(simplified, street_network, start, end, passed, chain_streets, lengths, max_speed)
+
+    return simplified
+
+
+def _other_end(neighbors, node, street_index):
+    for neighbor, neighbor_street_index in neighbors[node]:
+        if neighbor_street_index == street_index:
+            return neighbor
+
+
+def _add_chain(simplified, street_network, start, end, passed, chain_streets, lengths, max_speed):
+    # add the chain from start to end as one street; if that street already
+    # exists (or start and end are the same node), the first and last nodes
+    # passed are kept as well so that the network stays free of duplicates
+    if start != end and not simplified.has_street((start, end)):
+        _add_merged_street(simplified, street_network, start, end, passed, chain_streets, lengths, max_speed)
+        return
+
+    split_nodes = [passed[0]] if start != end or len(passed) == 1 else [passed[0], passed[-1]]
+    for node in split_nodes:
+        if not simplified.has_node(node):
+            longitude, latitude = street_network.node_coordinates(node)
+            simplified.add_node(node, longitude, latitude)
+    if len(split_nodes) == 1:
+        _add_merged_street(simplified, street_network, start, passed[0], [], chain_streets[:1], lengths, max_speed)
+        _add_merged_street(simplified, street_network, passed[0], end, passed[1:], chain_streets[1:], lengths, max_speed)
+    else:
+        _add_merged_street(simplified, street_network, start, passed[0], [], chain_streets[:1], lengths, max_speed)
+        _add_merged_street(simplified, street_network, passed[0], passed[-1], passed[1:-1], chain_streets[1:-1], lengths, max_speed)
+        _add_merged_street(simplified, street_network, passed[-1], end, [], chain_streets[-1:], lengths, max_speed)
+
+
+def _add_merged_street(simplified, street_network, start, end, passed, chain_streets, lengths, max_speed):
+    # the geometry consists of the nodes passed and the geometry of the
+    # merged streets (if they have been simplified before)
+    geometry = []
+    node = start
+    for position, street_index in enumerate(chain_streets):
+        next_node = passed[position] if position < len(passed) else end
+        street_geometry = street_network.get_street_geometry(street_index)
+        geometry.extend(street_geometry if node < next_node else reversed(street_geometry))
+        if position < len(passed):
+            geometry.append(street_network.node_coordinates(next_node))
+        node = next_node
+    simplified.add_street((start, end), sum(lengths[street_index] for street_index in chain_streets), max_speed, geometry)
@@ -23,90 +23,216 @@
 
 from time import time
 from math import sqrt
-from operator import itemgetter
+from heapq import nsmallest
 from array import array
 from itertools import repeat
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from osmdata import GraphBuilder
+from tripgenerator import TripTable
 from streetnetwork import StreetNetwork
 from settings import settings
+from utils import as_numpy
 
-# This class does the actual simulation steps
+# This class does the actual simulation steps for a list of trip tables,
+# each one with the traffic jam tolerance of its residents
 class Simulation(object):
 
-    def __init__(self, street_network, trips, jam_tolerance, log_callback):
+    def __init__(self, street_network, trip_tables, log_callback):
         self.street_network = street_network
-        self.trips = trips
-        self.jam_tolerance = jam_tolerance
+        self.trip_tables = trip_tables
         self.log_callback = log_callback
         self.step_counter = 0
         self.traffic_load = array("I", repeat(0, self.street_network.street_index))
+        # buffer the traffic load of every step is counted in, separate from
+        # the previous traffic load that driving times are calculated from
+        self._local_traffic_load = array("I", self.traffic_load)
+        # street lengths, max speeds and ideal speeds, which only change
+        # with road construction
+        self._edges = None
+        # seconds spent on each origin during the last step
+        self.origin_costs = dict()
 
         self.cumulative_traffic_load = None
 
 
-    def step(self):
-        self.step_counter += 1
-        self.log_callback("Preparing edges...")
-
-        # update driving time based on traffic load
-        for street, street_index, length, max_speed in self.street_network:
-            street_traffic_load = self.traffic_load[street_index]
+    def trip_keys(self):
+        # (trip table, origin) pairs of all trips
+        return [(table, origin) for table, trips in enumerate(self.trip_tables) for origin in trips.keys()]
 
-            # ideal speed is when the street is empty
-            ideal_speed = calculate_driving_speed(length, max_speed, 0)
-            # actual speed may be less then that
-            actual_speed = calculate_driving_speed(length, max_speed, street_traffic_load)
-            # based on traffic jam tolerance the deceleration is weighted differently
-            perceived_speed = actual_speed + (ideal_speed - actual_speed) * self.jam_tolerance
 
-            driving_time = length / perceived_speed
+    def step(self, trip_keys = None):
+        # trip_keys defaults to all (trip table, origin) pairs, but can be
+        # any iterable over a subset of them (see scheduler.py)
+        self.step_counter += 1
+        self.log_callback("Preparing edges...")
 
-            self.street_network.set_driving_time(street, driving_time)
+        # driving times are based on the traffic load of the previous step
+        # and the traffic jam tolerance of the trips
+        self.prepare_edges()
+        previous_traffic_load = self.traffic_load
+        jam_tolerance = None
 
         # reset traffic load
-        self.traffic_load = array("I", repeat(0, self.street_network.street_index))
+        if numpy is not None:
+            as_numpy(self._local_traffic_load).fill(0)
+        else:
+            self._local_traffic_load[:] = array("I", repeat(0, len(self._local_traffic_load)))
+        self.traffic_load = self._local_traffic_load
+
+        if trip_keys is None:
+            trip_keys = self.trip_keys()
+        self.origin_costs = dict()
 
         origin_nr = 0
-        for origin in self.trips.keys():
+        for table, origin in trip_keys:
+            origin_start = time()
+            trips = self.trip_tables[table]
+            if trips.jam_tolerance != jam_tolerance:
+                jam_tolerance = trips.jam_tolerance
+                street_lengths, max_speeds, ideal_speeds = self._edges
+                self.street_network.set_driving_times(calculate_driving_times(street_lengths, max_speeds, previous_traffic_load,
+                                                                              jam_tolerance, ideal_speeds))
+
             # calculate all shortest paths from resident to every other node
             origin_nr += 1
             self.log_callback("Origin nr", str(origin_nr) + "...")
-            paths = self.street_network.calculate_shortest_paths(origin)
-
-            # increase traffic load
-            for goal in self.trips[origin]:
-                # is the goal even reachable at all? if not, ignore for now
-                if goal in paths:
-                    # hop along the edges until we're there
-                    current = goal
-                    while current != origin:
-                        street = (min(current, paths[current]), max(current, paths[current]))
-                        current = paths[current]
-                        usage = settings["trip_volume"]
-                        street_index = self.street_network.get_street_index(street)
-                        self.traffic_load[street_index] += usage
+            goals = trips[origin]
+            goal_nodes = [goal for goal in goals if self.street_network.has_node(goal)]
+            tree_origin, tree_goals, predecessors, predecessor_streets = self.street_network.calculate_shortest_path_tree(origin, goal_nodes)
+
+            # increase traffic load by the number of residents going to each
+            # goal (the tree may identify goals differently than the trips)
+            goal_counts = dict()
+            for tree_goal, goal in zip(tree_goals, goal_nodes):
+                goal_counts[tree_goal] = goal_counts.get(tree_goal, 0) + goals[goal]
+            accumulate_traffic_load(self.traffic_load, tree_origin, goal_counts, predecessors, predecessor_streets, settings["trip_volume"])
+            self.origin_costs[(table, origin)] = time() - origin_start
+
+        statistics = self.street_network.shortest_path_statistics()
+        if statistics is not None:
+            self.log_callback("Shortest path trees:", statistics["reused"], "reused,", statistics["repaired"], "repaired (" +
+                              str(statistics["repaired_nodes"]), "nodes searched),", statistics["recalculated"], "calculated from scratch")
+
+
+    def prepare_edges(self):
+        # everything about the streets that does not depend on the traffic
+        # load, so that it can be done while waiting for the other processes
+        if self._edges is None:
+            street_lengths = self.street_network.get_street_lengths()
+            max_speeds = self.street_network.get_max_speeds()
+            ideal_speeds = calculate_driving_speeds(street_lengths, max_speeds, repeat(0, len(street_lengths)) if numpy is None else 0)
+            self._edges = (street_lengths, max_speeds, ideal_speeds)
 
 
     def road_construction(self):
-        dict_traffic_load = dict()
-        for i in range(0, len(self.cumulative_traffic_load)):
-            street = self.street_network.get_street_by_index(i)
-            dict_traffic_load[street] = self.cumulative_traffic_load[i]
-        sorted_traffic_load = sorted(dict_traffic_load.iteritems(), key = itemgetter(1))
-        max_decrease_index =  0.15 * len(sorted_traffic_load) # bottom 15%
-        min_increase_index = 0.95 * len(sorted_traffic_load) # top 5%
-        for i in range(len(sorted_traffic_load)):
-            if i <= max_decrease_index:
-                if not self.street_network.change_maxspeed(sorted_traffic_load[i][0], -20):
-                    max_decrease_index += 1
-            j = len(sorted_traffic_load) - i - 1
-            if j >= min_increase_index:
-                if not self.street_network.change_maxspeed(sorted_traffic_load[j][0], 20):
-                    min_increase_index -= 1
-            if max_decrease_index >= min_increase_index:
-                break
+        # slow down the least used streets and speed up the most used ones,
+        # only counting streets whose max speed can still change that way
+        traffic_load = self.cumulative_traffic_load
+        number_of_streets = len(traffic_load)
+        number_of_decreases = int(settings["road_construction_decrease_share"] * number_of_streets)
+        number_of_increases = int(settings["road_construction_increase_share"] * number_of_streets)
+        max_speed_change = settings["road_construction_speed_change"]
+        max_speeds = self.street_network.get_max_speeds()
+
+        if numpy is not None:
+            traffic_load = as_numpy(traffic_load)
+            max_speeds = as_numpy(max_speeds)
+            decreased_streets = select_streets(traffic_load, numpy.flatnonzero(max_speeds > 1), number_of_decreases, False)
+            can_increase = max_speeds < 140
+            can_increase[decreased_streets] = False
+            increased_streets = select_streets(traffic_load, numpy.flatnonzero(can_increase), number_of_increases, True)
+        else:
+            decreased_streets = select_streets(traffic_load, [street for street in xrange(number_of_streets) if max_speeds[street] > 1],
+                                               number_of_decreases, False)
+            decreased = set(decreased_streets)
+            increased_streets = select_streets(traffic_load, [street for street in xrange(number_of_streets)
+                                                              if max_speeds[street] < 140 and street not in decreased],
+                                               number_of_increases, True)
+
+        self.street_network.change_max_speeds(decreased_streets, -max_speed_change)
+        self.street_network.change_max_speeds(increased_streets, max_speed_change)
         self.cumulative_traffic_load = None
+        self._edges = None
+
+
+def select_streets(traffic_load, candidates, number_of_streets, largest):
+    # the given number of candidate streets (sorted by index) with the
+    # smallest or largest traffic load, ties are broken by the lower index;
+    # all processes must get the same result
+    number_of_streets = min(number_of_streets, len(candidates))
+    if number_of_streets <= 0:
+        return candidates[:0]
+
+    if numpy is not None:
+        loads = traffic_load[candidates].astype(numpy.int64)
+        if largest:
+            loads = -loads
+        # partial selection of the load the last selected street has
+        boundary = numpy.partition(loads, number_of_streets - 1)[number_of_streets - 1]
+        below = candidates[loads < boundary]
+        return numpy.concatenate((below, candidates[loads == boundary][:number_of_streets - len(below)]))
+
+    sign = -1 if largest else 1
+    return nsmallest(number_of_streets, candidates, key = lambda street: (sign * traffic_load[street], street))
+
+
+def accumulate_traffic_load(traffic_load, origin, goal_counts, predecessors, predecessor_streets, trip_volume):
+    # instead of walking every path from its goal to the origin, every
+    # street of the shortest path tree is visited once and charged with all
+    # trips ending below it
+
+    # mark the part of the tree that leads to reachable goals and count how
+    # many of its children each of those nodes has
+    children = dict()
+    trips_below = dict()
+    for goal, count in goal_counts.iteritems():
+        if goal != origin and predecessors[goal] < 0:
+            # goal is not reachable at all, ignore for now
+            continue
+        trips_below[goal] = count
+        if goal in children:
+            continue
+        children[goal] = 0
+        node = goal
+        while node != origin:
+            node = predecessors[node]
+            if node in children:
+                children[node] += 1
+                break
+            children[node] = 1
+
+    # pass the trip counts up from the leaves towards the origin
+    leaves = [node for node, number_of_children in children.iteritems() if number_of_children == 0]
+    while leaves:
+        node = leaves.pop()
+        if node == origin:
+            continue
+        trips = trips_below.get(node, 0)
+        traffic_load[predecessor_streets[node]] += trips * trip_volume
+        predecessor = predecessors[node]
+        trips_below[predecessor] = trips_below.get(predecessor, 0) + trips
+        children[predecessor] -= 1
+        if children[predecessor] == 0:
+            leaves.append(predecessor)
+
+
+def traffic_load_change(previous_traffic_load, traffic_load):
+    # sum of the absolute changes of all streets relative to the previous
+    # total traffic load
+    if numpy is not None:
+        previous_traffic_load = as_numpy(previous_traffic_load).astype(numpy.int64)
+        change = numpy.abs(as_numpy(traffic_load).astype(numpy.int64) - previous_traffic_load).sum()
+        return float(change) / max(previous_traffic_load.sum(), 1)
+
+    change = 0
+    for previous_load, load in zip(previous_traffic_load, traffic_load):
+        change += abs(load - previous_load)
+    return float(change) / max(sum(previous_traffic_load), 1)
 
 
 def calculate_driving_speed_var(street_length, max_speed, number_of_trips):
@@ -138,6 +264,65 @@ def calculate_driving_speed(street_length, max_speed, number_of_trips):
     return actual_speed
 
 
+# The following functions do the same as the ones above, but for all streets
+# at once. They take sequences indexed by street index and return a numpy
+# array if numpy is available and a list otherwise.
+
+def calculate_driving_speeds_var(street_lengths, max_speeds, numbers_of_trips):
+    intermediate_quotient_dividend = settings["traffic_period_duration"] * 3600 * settings["braking_deceleration"]
+    braking_term = 2 * settings["car_length"] * settings["braking_deceleration"]
+
+    if numpy is not None:
+        intermediate_quotient_result = intermediate_quotient_dividend / numpy.maximum(as_numpy(numbers_of_trips), 1)
+        potential_speeds = numpy.sqrt(intermediate_quotient_result**2 + braking_term) + intermediate_quotient_result # m/s
+        return numpy.minimum(as_numpy(max_speeds), potential_speeds * 3.6) # km/h
+
+    actual_speeds = []
+    for max_speed, number_of_trips in zip(max_speeds, numbers_of_trips):
+        intermediate_quotient_result = intermediate_quotient_dividend / max(number_of_trips, 1)
+        potential_speed = sqrt(intermediate_quotient_result**2 + braking_term) + intermediate_quotient_result
+        actual_speeds.append(min(max_speed, potential_speed * 3.6))
+    return actual_speeds
+
+
+def calculate_driving_speeds(street_lengths, max_speeds, numbers_of_trips):
+    car_length = settings["car_length"]
+    min_breaking_distance = settings["min_breaking_distance"]
+    braking_deceleration = settings["braking_deceleration"]
+
+    if numpy is not None:
+        available_space_for_each_car = as_numpy(street_lengths) / numpy.maximum(as_numpy(numbers_of_trips), 1) # m
+        available_braking_distance = numpy.maximum(available_space_for_each_car - car_length, min_breaking_distance) # m
+        potential_speeds = numpy.sqrt(braking_deceleration * available_braking_distance * 2) # m/s
+        return numpy.minimum(as_numpy(max_speeds), potential_speeds * 3.6) # km/h
+
+    actual_speeds = []
+    for street_length, max_speed, number_of_trips in zip(street_lengths, max_speeds, numbers_of_trips):
+        available_braking_distance = max(street_length / max(number_of_trips, 1) - car_length, min_breaking_distance)
+        potential_speed = sqrt(braking_deceleration * available_braking_distance * 2)
+        actual_speeds.append(min(max_speed, potential_speed * 3.6))
+    return actual_speeds
+
+
+def calculate_driving_times(street_lengths, max_speeds, traffic_load, jam_tolerance, ideal_speeds = None):
+    # ideal speed is when the street is empty
+    if ideal_speeds is None:
+        ideal_speeds = calculate_driving_speeds(street_lengths, max_speeds, repeat(0, len(street_lengths)) if numpy is None else 0)
+    # actual speed may be less then that
+    actual_speeds = calculate_driving_speeds(street_lengths, max_speeds, traffic_load)
+
+    if numpy is not None:
+        # based on traffic jam tolerance the deceleration is weighted differently
+        perceived_speeds = actual_speeds + (ideal_speeds - actual_speeds) * jam_tolerance
+        return as_numpy(street_lengths) / perceived_speeds
+
+    driving_times = []
+    for street_length, ideal_speed, actual_speed in zip(street_lengths, ideal_speeds, actual_speeds):
+        perceived_speed = actual_speed + (ideal_speed - actual_speed) * jam_tolerance
+        driving_times.append(street_length / perceived_speed)
+    return driving_times
+
+
 if __name__ == "__main__":
     def out(*output):
         for o in output:
@@ -151,10 +336,9 @@ if __name__ == "__main__":
     street_network.add_street((1, 2,), 10, 50)
     street_network.add_street((2, 3,), 100, 140)
 
-    trips = dict()
-    trips[1] = [3]
+    trips = TripTable(array("l", [1]), array("l", [0, 1]), array("l", [3]), array("I", [1]), 0.5)
 
-    sim = Simulation(street_network, trips, out)
+    sim = Simulation(street_network, [trips], out)
     for step in range(10):
         print "Running simulation step", step + 1, "of 10..."
         sim.step()
@@ -21,8 +21,15 @@
 # along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from collections import defaultdict
+from operator import itemgetter
+
 from pygraph.classes.graph import graph
 from pygraph.algorithms.minmax import shortest_path
+from pygraph.algorithms.accessibility import connected_components
+
+from arraystreetnetwork import ArrayStreetNetwork
+from settings import settings
 
 # This class represents a street network
 class StreetNetwork(object):
@@ -39,13 +46,16 @@ class StreetNetwork(object):
         # give every street a sequential index (used for perfomance optimization)
         self.street_index = 0
         self.streets_by_index = dict()
+        # coordinates of the points between the end nodes of streets that
+        # replace a chain of streets, see simplification.py
+        self.street_geometries = dict()
 
 
     def has_street(self, street):
         return self._graph.has_edge(street)
 
 
-    def add_street(self, street, length, max_speed):
+    def add_street(self, street, length, max_speed, geometry = None):
         # attribute order is given through constants ATTRIBUTE_INDEX_...
         street_attributes = [self.street_index, length, max_speed]
         # set initial weight to ideal driving time
@@ -53,6 +63,9 @@ class StreetNetwork(object):
 
         self._graph.add_edge(street, wt=driving_time, attrs=street_attributes)
         self.streets_by_index[self.street_index] = street
+        if geometry:
+            # stored from the lower node id to the higher one
+            self.street_geometries[self.street_index] = list(geometry) if street[0] < street[1] else list(reversed(geometry))
 
         self.street_index += 1
 
@@ -61,6 +74,14 @@ class StreetNetwork(object):
         self._graph.set_edge_weight(street, driving_time)
 
 
+    def set_driving_times(self, driving_times):
+        # driving times for all streets, indexed by street index
+        if hasattr(driving_times, "tolist"):
+            driving_times = driving_times.tolist()
+        for street_index, street in self.streets_by_index.iteritems():
+            self._graph.set_edge_weight(street, driving_times[street_index])
+
+
     def get_driving_time(self, street):
         return self._graph.edge_weight(street)
 
@@ -76,10 +97,47 @@ class StreetNetwork(object):
             return None
 
 
+    def get_street_geometry(self, street_index):
+        # (longitude, latitude) of the points between the end nodes of a
+        # street, from the lower node id to the higher one
+        return self.street_geometries.get(street_index, [])
+
+
+    def get_street_lengths(self):
+        return self._street_attribute_list(StreetNetwork.STREET_ATTRIBUTE_INDEX_LENGTH)
+
+
+    def get_max_speeds(self):
+        return self._street_attribute_list(StreetNetwork.STREET_ATTRIBUTE_INDEX_MAX_SPEED)
+
+
+    def _street_attribute_list(self, attribute_index):
+        values = [0] * self.street_index
+        for street_index, street in self.streets_by_index.iteritems():
+            values[street_index] = self._graph.edge_attributes(street)[attribute_index]
+        return values
+
+
+    def set_max_speeds(self, max_speeds):
+        # max speeds for all streets, indexed by street index
+        if len(max_speeds) != self.street_index:
+            raise ValueError("Expected max speeds for " + str(self.street_index) + " streets, got " + str(len(max_speeds)))
+        for street_index, street in self.streets_by_index.iteritems():
+            self._graph.edge_attributes(street)[StreetNetwork.STREET_ATTRIBUTE_INDEX_MAX_SPEED] = max_speeds[street_index]
+
+
     def change_maxspeed(self, street, max_speed_delta):
+        # returns whether the max speed actually changed
         street_attributes = self._graph.edge_attributes(street)
         current_max_speed = street_attributes[StreetNetwork.STREET_ATTRIBUTE_INDEX_MAX_SPEED]
         street_attributes[StreetNetwork.STREET_ATTRIBUTE_INDEX_MAX_SPEED] = max(1, min(140, current_max_speed + max_speed_delta))
+        return street_attributes[StreetNetwork.STREET_ATTRIBUTE_INDEX_MAX_SPEED] != current_max_speed
+
+
+    def change_max_speeds(self, street_indices, max_speed_delta):
+        # same as change_maxspeed for many streets at once, given by index
+        for street_index in street_indices:
+            self.change_maxspeed(self.streets_by_index[street_index], max_speed_delta)
 
 
     def set_bounds(self, min_latitude, max_latitude, min_longitude, max_longitude):
@@ -105,10 +163,34 @@ class StreetNetwork(object):
         return self._graph.has_node(node)
 
 
-    def calculate_shortest_paths(self, origin_node):
+    def prepare_shortest_paths(self, filename = None):
+        # pygraph needs no preprocessing
+        pass
+
+
+    def calculate_shortest_paths(self, origin_node, goal_nodes = None):
+        # pygraph always calculates the full shortest path tree
         return shortest_path(self._graph, origin_node)[0]
 
 
+    def calculate_shortest_path_tree(self, origin_node, goal_nodes = None):
+        # same as in ArrayStreetNetwork, nodes are identified by their OSM id
+        spanning_tree = shortest_path(self._graph, origin_node)[0]
+        predecessors = defaultdict(lambda: -1, spanning_tree)
+        predecessors[origin_node] = -1
+
+        return origin_node, goal_nodes, predecessors, _PredecessorStreets(self, predecessors)
+
+
+    def shortest_path_statistics(self):
+        # pygraph keeps no state between shortest path calculations
+        return None
+
+
+    def connected_components(self):
+        return connected_components(self._graph)
+
+
     # iterator to iterate over the streets and their attributes
     def __iter__(self):
         for street in self._graph.edges():
@@ -123,3 +205,47 @@ class StreetNetwork(object):
             street_attributes = self._graph.edge_attributes(street)
 
             yield (street, street_attributes[StreetNetwork.STREET_ATTRIBUTE_INDEX_INDEX], street_attributes[StreetNetwork.STREET_ATTRIBUTE_INDEX_LENGTH], street_attributes[StreetNetwork.STREET_ATTRIBUTE_INDEX_MAX_SPEED])
+
+
+# This class looks up the street leading to a node of a shortest path tree
+# only when it is needed
+class _PredecessorStreets(object):
+
+    def __init__(self, street_network, predecessors):
+        self.street_network = street_network
+        self.predecessors = predecessors
+
+    def __getitem__(self, node):
+        predecessor = self.predecessors[node]
+        return self.street_network.get_street_index((min(node, predecessor), max(node, predecessor)))
+
+
+# This function creates an empty street network using the storage backend
+# chosen in the settings
+def create_street_network(backend = None):
+    if backend is None:
+        backend = settings["street_network_backend"]
+    if backend == "pygraph":
+        return StreetNetwork()
+    if backend == "array":
+        return ArrayStreetNetwork()
+    raise ValueError("Unknown street network backend: " + str(backend))
+
+
+# This function returns the given street network using another storage
+# backend, keeping all node ids, coordinates and street indices
+def convert_street_network(street_network, backend = None):
+    converted = create_street_network(backend)
+    if type(converted) is type(street_network):
+        return street_network
+
+    if street_network.bounds is not None:
+        converted.set_bounds(street_network.bounds[0][0], street_network.bounds[0][1],
+                             street_network.bounds[1][0], street_network.bounds[1][1])
+    for node in street_network.get_nodes():
+        longitude, latitude = street_network.node_coordinates(node)
+        converted.add_node(node, longitude, latitude)
+    for street, street_index, length, max_speed in sorted(street_network, key = itemgetter(1)):
+        converted.add_street(street, length, max_speed, street_network.get_street_geometry(street_index))
+
+    return converted
@@ -21,92 +21,338 @@
 # along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import sys
 from datetime import datetime
-from random import random
-from random import seed
+from time import time
 from array import array
 from itertools import repeat
+from multiprocessing import cpu_count
 
 from mpi4py import MPI
 
-from osmdata import GraphBuilder
-from tripgenerator import TripGenerator
-from simulation import Simulation
+from networkcache import load_street_network
+from tripgenerator import TripGenerator, cluster_origins, landuse_node_weights
+from simulation import Simulation, traffic_load_change
+from scheduler import OriginScheduler
+from trafficexchange import TrafficLoadExchange
+from checkpoint import write_checkpoint, read_checkpoint
+from trafficstore import TrafficLoadStore, TRAFFIC_LOAD_FILENAME
+from outputwriter import OutputWriter
 from settings import settings
 from persistence import persist_write
-from utils import merge_arrays
+from networkio import pack_street_network, unpack_street_network, NetworkSnapshotWriter, SNAPSHOT_FILENAME
+from utils import add_array
 
 # This class runs the Streets4MPI program.
 class Streets4MPI(object):
 
-    def __init__(self):
+    def __init__(self, resume = False):
+        # with resume, the simulation continues from the last complete
+        # checkpoint (if there is one) instead of starting from the beginning
+
         # get process info from mpi
         communicator = MPI.COMM_WORLD
         self.process_rank = communicator.Get_rank()
         number_of_processes = communicator.Get_size()
 
         self.log("Welcome to Streets4MPI!")
-        # set random seed based on process rank
-        random_seed = settings["random_seed"] + (37 * self.process_rank)
-        seed(random_seed)
 
-        self.log("Reading OpenStreetMap data...")
-        data = GraphBuilder(settings["osm_file"])
+        # with "none", every process reads the OpenStreetMap data itself,
+        # otherwise only the first process does and passes the result on
+        distribution = settings["street_network_distribution"]
+        if number_of_processes == 1:
+            distribution = "none"
+        street_network = None
+        node_categories = None
+        if distribution == "none" or self.process_rank == 0:
+            concurrency = settings["osm_parser_concurrency"]
+            if concurrency is None:
+                # forking worker processes after MPI has been initialized is
+                # not safe with many MPI implementations, so all cores are
+                # only used without other MPI processes
+                concurrency = cpu_count() if number_of_processes == 1 else 1
+            street_network, node_categories = load_street_network(settings["osm_file"], concurrency, self.log, self.log_indent)
 
-        self.log("Building street network...")
-        street_network = data.build_street_network()
+        # window holding the street network shared by the processes on a node
+        self.street_network_window = None
+        if distribution != "none":
+            self.log("Receiving street network..." if self.process_rank != 0 else "Distributing street network...")
+            street_network, node_categories = self.distribute_street_network(communicator, street_network, node_categories, distribution)
+        residential_nodes, commercial_nodes, industrial_nodes = node_categories
 
-        if self.process_rank == 0 and settings["persist_traffic_load"]:
-            self.log_indent("Saving street network to disk...")
-            persist_write("street_network_1.s4mpi", street_network)
+        if settings["shortest_path_engine"] == "cch":
+            # the first process reuses or creates the preprocessing file, the
+            # others wait for it and read it
+            self.log("Preparing shortest path calculation...")
+            if self.process_rank == 0:
+                street_network.prepare_shortest_paths("street_network_cch.s4mpi")
+            communicator.Barrier()
+            if self.process_rank != 0:
+                street_network.prepare_shortest_paths("street_network_cch.s4mpi")
 
-        self.log("Locating area types...")
-        data.find_node_categories()
+        checkpoint = None
+        if resume:
+            self.log("Reading checkpoint...")
+            checkpoint = read_checkpoint(communicator, settings["checkpoint_directory"])
+            if checkpoint is None:
+                self.log_indent("No complete checkpoint found, starting from the beginning")
+            else:
+                self.log_indent("Resuming with step", checkpoint["step"] + 1)
 
         self.log("Generating trips...")
-        trip_generator = TripGenerator()
-        # distribute residents over processes
-        number_of_residents = settings["number_of_residents"] / number_of_processes
+        dynamic_scheduling = settings["origin_scheduling"] == "dynamic"
         if settings["use_residential_origins"]:
-            potential_origins = data.connected_residential_nodes
+            potential_origins = residential_nodes
         else:
             potential_origins = street_network.get_nodes()
-        potential_goals = data.connected_commercial_nodes | data.connected_industrial_nodes
-        trips = trip_generator.generate_trips(number_of_residents, potential_origins, potential_goals)
+        potential_goals = commercial_nodes | industrial_nodes
+        origin_clusters = None
+        if settings["origin_cell_size"] is not None:
+            origin_clusters = cluster_origins(street_network, potential_origins, settings["origin_cell_size"])
+        node_weights = None
+        if settings["landuse_weights"] is not None:
+            node_weights = landuse_node_weights(settings["landuse_weights"], residential_nodes, commercial_nodes, industrial_nodes)
+        # the residents are divided into one trip table per process, each
+        # drawn with the seed of that process together with the traffic jam
+        # tolerance of its residents
+        number_of_residents = settings["number_of_residents"] / number_of_processes
+        def generate_trip_table(process_rank):
+            process_seed = None
+            if settings["random_seed"] is not None:
+                process_seed = settings["random_seed"] + (37 * process_rank)
+            return TripGenerator(process_seed).generate_trips(number_of_residents, potential_origins, potential_goals, origin_clusters, node_weights)
+        if checkpoint is not None:
+            trip_tables = checkpoint["trip_tables"]
+        elif dynamic_scheduling:
+            # all processes share all trip tables and take origins from them
+            # on demand, so the results are the same as with static scheduling
+            trip_tables = None
+            if self.process_rank == 0:
+                trip_tables = [generate_trip_table(process_rank) for process_rank in range(number_of_processes)]
+            trip_tables = communicator.bcast(trip_tables)
+        else:
+            trip_tables = [generate_trip_table(self.process_rank)]
 
-        # set traffic jam tolerance for this process and its trips
-        jam_tolerance = random()
-        self.log("Setting traffic jam tolerance to", str(round(jam_tolerance, 2)) + "...")
+        for trips in trip_tables:
+            self.log_indent(len(trips), "origins for", trips.number_of_residents(), "residents with traffic jam tolerance",
+                            round(trips.jam_tolerance, 2))
 
         # run simulation
-        simulation = Simulation(street_network, trips, jam_tolerance, self.log_indent)
+        simulation = Simulation(street_network, trip_tables, self.log_indent)
+        if dynamic_scheduling:
+            scheduler = OriginScheduler(communicator, simulation.trip_keys(), settings["origin_batches_per_process"])
+            if checkpoint is not None:
+                scheduler.restore_costs(checkpoint["origin_costs"])
 
-        for step in range(settings["max_simulation_steps"]):
+        # the total traffic load is received into these buffers in turns, so
+        # that the one of the previous step stays available
+        total_traffic_load_buffers = [array("I", repeat(0, street_network.street_index)) for i in range(2)]
+        traffic_load_exchange = TrafficLoadExchange(communicator, street_network.street_index, settings["traffic_load_exchange"])
+
+        # relative change of the total traffic load in every step
+        convergence_history = []
+        previous_traffic_load = None
+        step = 0
+        if checkpoint is not None:
+            # the driving times follow from the max speeds and the traffic
+            # load at the beginning of the next step
+            street_network.set_max_speeds(checkpoint["max_speeds"])
+            total_traffic_load_buffers[0][:] = checkpoint["traffic_load"]
+            simulation.traffic_load = previous_traffic_load = total_traffic_load_buffers[0]
+            simulation.cumulative_traffic_load = checkpoint["cumulative_traffic_load"]
+            simulation.step_counter = checkpoint["step_counter"]
+            convergence_history = checkpoint["convergence_history"]
+            step = checkpoint["step"]
+        last_checkpoint_step = step
+
+        # the first process appends the traffic load of every step and the
+        # max speeds after every road construction to files
+        traffic_load_store = None
+        network_snapshot = None
+        output_writer = None
+        if self.process_rank == 0 and settings["persist_traffic_load"]:
+            codec, level = settings["output_codec"], settings["output_compression_level"]
+            if checkpoint is not None:
+                # the steps after the checkpoint are simulated again
+                traffic_load_store = TrafficLoadStore(TRAFFIC_LOAD_FILENAME, street_network.street_index, "a", codec, level)
+                traffic_load_store.truncate(step)
+                network_snapshot = NetworkSnapshotWriter(SNAPSHOT_FILENAME, street_network, step)
+            else:
+                traffic_load_store = TrafficLoadStore(TRAFFIC_LOAD_FILENAME, street_network.street_index, "w", codec, level)
+                self.log_indent("Saving street network to disk...")
+                network_snapshot = NetworkSnapshotWriter(SNAPSHOT_FILENAME, street_network)
+            # compressing and writing the outputs of a step happens in the
+            # background while the next steps are simulated
+            output_writer = OutputWriter(settings["output_queue_size"])
+        del checkpoint
+
+        while step < settings["max_simulation_steps"]:
 
             if step > 0 and step % settings["steps_between_street_construction"] == 0:
                 self.log_indent("Road construction taking place...")
                 simulation.road_construction()
-                if self.process_rank == 0 and settings["persist_traffic_load"]:
-                    persist_write("street_network_" + str(step + 1) + ".s4mpi", simulation.street_network)
+                if network_snapshot is not None:
+                    network_snapshot.add(step + 1, simulation.street_network)
 
             self.log("Running simulation step", step + 1, "of", str(settings["max_simulation_steps"]) + "...")
-            simulation.step()
+            if dynamic_scheduling:
+                simulation.step(scheduler.origins_for_step())
+            else:
+                simulation.step()
 
-            # gather local traffic loads from all other processes
+            # gather local traffic loads from all other processes in the
+            # background while doing what does not depend on them
             self.log("Exchanging traffic load data between nodes...")
-            total_traffic_load = array("I", repeat(0, len(simulation.traffic_load)))
-            communicator.Allreduce(simulation.traffic_load, total_traffic_load, MPI.SUM)
+            total_traffic_load_buffers.reverse()
+            total_traffic_load = total_traffic_load_buffers[0]
+            traffic_load_exchange.start(simulation.traffic_load, total_traffic_load)
+
+            # time spent waiting for the slowest process
+            idle_start = time()
+            communicator.Barrier()
+            self.log_indent("Idle time waiting for other processes:", round(time() - idle_start, 3), "s")
+            if dynamic_scheduling:
+                scheduler.end_step(simulation.origin_costs)
+            if (step + 1) % settings["steps_between_street_construction"] != 0:
+                # unless the next step starts with road construction, the
+                # street attributes it needs are the same as now
+                simulation.prepare_edges()
+
+            wait_start = time()
+            traffic_load_exchange.wait()
+            self.log_indent("Waiting for traffic load data took", round(time() - wait_start, 3), "s,",
+                            traffic_load_exchange.bytes, "bytes received per process (" + traffic_load_exchange.method + ")")
             simulation.traffic_load = total_traffic_load
-            simulation.cumulative_traffic_load = merge_arrays((total_traffic_load, simulation.cumulative_traffic_load))
+            if simulation.cumulative_traffic_load is None:
+                simulation.cumulative_traffic_load = array("I", total_traffic_load)
+            else:
+                add_array(simulation.cumulative_traffic_load, total_traffic_load)
 
-            if self.process_rank == 0 and settings["persist_traffic_load"]:
-                self.log_indent("Saving traffic load to disk...")
-                persist_write("traffic_load_" + str(step + 1) + ".s4mpi", total_traffic_load, is_array = True)
+            if output_writer is not None:
+                # the writer gets a copy, the buffer is used again two steps later
+                waiting_time = output_writer.put("traffic load of step " + str(step + 1),
+                                                 traffic_load_store.append, step + 1, total_traffic_load[:])
+                if waiting_time >= 0.001:
+                    self.log_indent("Waited", round(waiting_time, 3), "s for earlier outputs to be written")
 
+            # all processes have the same total traffic load, but the first one
+            # decides for all of them so that they never run different steps
+            change = None
+            if previous_traffic_load is not None:
+                change = communicator.bcast(traffic_load_change(previous_traffic_load, total_traffic_load))
+                self.log_indent("Relative traffic load change:", round(change, 5))
+            convergence_history.append(change)
+            if output_writer is not None:
+                output_writer.put("convergence history", persist_write, "convergence.s4mpi", list(convergence_history))
+                self.log_written_outputs(output_writer)
+            previous_traffic_load = total_traffic_load
             del total_traffic_load
 
+            step += 1
+            if change is not None and settings["convergence_threshold"] is not None and change < settings["convergence_threshold"]:
+                # continue with the next road construction, if there is one
+                steps_between_street_construction = settings["steps_between_street_construction"]
+                next_construction = -(-step // steps_between_street_construction) * steps_between_street_construction
+                if settings["convergence_action"] == "stop" or next_construction >= settings["max_simulation_steps"]:
+                    self.log("Traffic load has converged, stopping...")
+                    break
+                if next_construction > step:
+                    self.log("Traffic load has converged, skipping to step", str(next_construction + 1) + "...")
+                    step = next_construction
+
+            checkpoint_interval = settings["checkpoint_interval"]
+            if checkpoint_interval is not None and step - last_checkpoint_step >= checkpoint_interval and step < settings["max_simulation_steps"]:
+                self.log("Writing checkpoint...")
+                if output_writer is not None:
+                    # a resumed run only writes the steps after the checkpoint
+                    # again, so all outputs up to it must be on disk first
+                    output_writer.flush()
+                    self.log_written_outputs(output_writer)
+                if network_snapshot is not None:
+                    network_snapshot.flush()
+                write_checkpoint(communicator, settings["checkpoint_directory"], step, {
+                    "max_speeds" : list(street_network.get_max_speeds()),
+                    "traffic_load" : simulation.traffic_load,
+                    "cumulative_traffic_load" : simulation.cumulative_traffic_load,
+                    "trip_tables" : trip_tables,
+                    "step_counter" : simulation.step_counter,
+                    "convergence_history" : convergence_history,
+                    "origin_costs" : scheduler.costs if dynamic_scheduling else None,
+                })
+                last_checkpoint_step = step
+
+        if dynamic_scheduling:
+            scheduler.close()
+        if output_writer is not None:
+            self.log("Waiting for outputs to be written...")
+            output_writer.close()
+            self.log_written_outputs(output_writer)
+            traffic_load_store.close()
+        if network_snapshot is not None:
+            network_snapshot.close()
+        if self.street_network_window is not None:
+            del simulation, street_network
+            self.street_network_window.Free()
+
         self.log("Done!")
 
+    def distribute_street_network(self, communicator, street_network, node_categories, distribution):
+        # the area types are small compared to the network and simply pickled;
+        # the first process keeps its own sets so that it draws the same trips
+        # as without distribution
+        received_categories = communicator.bcast(node_categories)
+        if self.process_rank != 0:
+            node_categories = received_categories
+        if settings["street_network_backend"] != "array":
+            # pygraph networks have no compact binary form
+            return communicator.bcast(street_network), node_categories
+
+        packed = None
+        size = array("L", [0])
+        if self.process_rank == 0:
+            packed = pack_street_network(street_network)
+            size[0] = len(packed)
+        communicator.Bcast([size, MPI.UNSIGNED_LONG])
+        size = size[0]
+        self.log_indent("Packed street network size:", size, "bytes")
+
+        if distribution == "broadcast":
+            # every process gets a private copy
+            if self.process_rank != 0:
+                packed = bytearray(size)
+            communicator.Bcast([packed, MPI.BYTE])
+            if self.process_rank != 0:
+                street_network = unpack_street_network(packed)
+            return street_network, node_categories
+
+        # "shared": the network is only sent to one process per node, which
+        # receives it directly into memory shared with the other processes
+        # on that node; they all use the same copy of the topology and only
+        # keep the arrays that change during the simulation to themselves
+        node_communicator = communicator.Split_type(MPI.COMM_TYPE_SHARED)
+        is_node_leader = node_communicator.Get_rank() == 0
+        leader_communicator = communicator.Split(0 if is_node_leader else MPI.UNDEFINED, self.process_rank)
+        self.street_network_window = MPI.Win.Allocate_shared(size if is_node_leader else 0, 1, comm = node_communicator)
+        memory = self.street_network_window.Shared_query(0)[0]
+        if is_node_leader:
+            if self.process_rank == 0:
+                memory[:size] = packed
+            leader_communicator.Bcast([memory, size, MPI.BYTE])
+            leader_communicator.Free()
+        node_communicator.Barrier()
+        node_communicator.Free()
+        if self.process_rank != 0:
+            street_network = unpack_street_network(memory, share_topology = True)
+        return street_network, node_categories
+
+    def log_written_outputs(self, output_writer):
+        # time from handing each output to the writer until it was written
+        for description, latency, size in output_writer.pop_finished():
+            if size is None:
+                self.log_indent("Wrote", description, "after", round(latency, 3), "s")
+            else:
+                self.log_indent("Wrote", description, "after", round(latency, 3), "s,", size, "bytes")
+
     def log(self, *output):
         if(settings["logging"] == "stdout"):
             print "[ %s ][ p%d ]" % (datetime.now(), self.process_rank),
@@ -122,5 +368,5 @@ class Streets4MPI(object):
             print ""
 
 if __name__ == "__main__":
-    Streets4MPI()
+    Streets4MPI(resume = "--resume" in sys.argv[1:])
 
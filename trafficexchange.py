@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# trafficexchange.py
+# Copyright 2012 Julian Fietkau <http://www.julian-fietkau.de/>,
+#                Joachim Nitschke
+#
+# This file is part of Streets4MPI.
+#
+# Streets4MPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Streets4MPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from mpi4py import MPI
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from utils import as_numpy
+
+# This class sums up the traffic loads of all processes. The exchange is
+# started with start() and finished with wait(), so that other work can be
+# done in between. Modes:
+# "dense"  - reduce the whole array of all streets
+# "sparse" - gather the index and traffic load of every street that has any
+#            traffic and sum them up locally
+# "auto"   - whichever of the two sends fewer bytes in the current step
+# Traffic loads are sent with the narrowest unsigned integer type that can
+# hold the sum of all processes' largest loads. Everything but the dense
+# exchange of 32-bit integers needs NumPy.
+class TrafficLoadExchange(object):
+
+    def __init__(self, communicator, number_of_streets, mode = "auto"):
+        if mode not in ("dense", "sparse", "auto"):
+            raise ValueError("Unknown traffic load exchange: " + str(mode))
+        self.communicator = communicator
+        self.number_of_streets = number_of_streets
+        self.mode = mode if numpy is not None else "dense"
+        # method and bytes received by every process in the last exchange
+        self.method = None
+        self.bytes = 0
+        if numpy is not None:
+            self._index_type = numpy.uint16 if number_of_streets <= 1 << 16 else numpy.uint32
+            self._process_info = numpy.zeros((communicator.Get_size(), 2), dtype = numpy.int64)
+        # send and receive buffers, kept from one step to the next
+        self._buffers = dict()
+        self._requests = []
+        self._total_traffic_load = None
+        self._finish = None
+
+
+    def start(self, traffic_load, total_traffic_load):
+        # total_traffic_load must not be used before wait() has returned
+        self._total_traffic_load = total_traffic_load
+        if numpy is None:
+            self.method = "dense"
+            self.bytes = 4 * self.number_of_streets
+            self._requests = [self.communicator.Iallreduce(traffic_load, total_traffic_load, MPI.SUM)]
+            self._finish = None
+            return
+
+        local_traffic_load = as_numpy(traffic_load)
+        streets = numpy.flatnonzero(local_traffic_load)
+        largest_load = local_traffic_load[streets].max() if len(streets) > 0 else 0
+        self.communicator.Allgather(numpy.array([len(streets), largest_load], dtype = numpy.int64), self._process_info)
+        load_type = _narrowest_type(self._process_info[:, 1].sum())
+        load_size = numpy.dtype(load_type).itemsize
+
+        dense_bytes = self.number_of_streets * load_size
+        number_of_entries = self._process_info[:, 0]
+        sparse_bytes = int(number_of_entries.sum()) * (numpy.dtype(self._index_type).itemsize + load_size)
+        if self.mode == "sparse" or (self.mode == "auto" and sparse_bytes < dense_bytes):
+            self.method = "sparse"
+            self.bytes = sparse_bytes
+            self._start_sparse(local_traffic_load, streets, number_of_entries, load_type)
+        else:
+            self.method = "dense"
+            self.bytes = dense_bytes
+            self._start_dense(traffic_load, local_traffic_load, load_type)
+
+
+    def wait(self):
+        MPI.Request.Waitall(self._requests)
+        self._requests = []
+        if self._finish is not None:
+            self._finish()
+            self._finish = None
+        return self._total_traffic_load
+
+
+    def _start_dense(self, traffic_load, local_traffic_load, load_type):
+        if load_type == numpy.uint32:
+            self._requests = [self.communicator.Iallreduce(traffic_load, self._total_traffic_load, MPI.SUM)]
+            self._finish = None
+            return
+
+        send = self._buffer("dense_send", load_type, self.number_of_streets)
+        receive = self._buffer("dense_receive", load_type, self.number_of_streets)
+        send[:] = local_traffic_load
+        mpi_type = MPI_TYPES[load_type]
+        self._requests = [self.communicator.Iallreduce([send, mpi_type], [receive, mpi_type], MPI.SUM)]
+        def finish():
+            as_numpy(self._total_traffic_load)[:] = receive
+        self._finish = finish
+
+
+    def _start_sparse(self, local_traffic_load, streets, number_of_entries, load_type):
+        total_entries = int(number_of_entries.sum())
+        offsets = numpy.zeros(len(number_of_entries), dtype = numpy.int64)
+        numpy.cumsum(number_of_entries[:-1], out = offsets[1:])
+        counts = number_of_entries.tolist()
+        offsets = offsets.tolist()
+
+        send_streets = self._buffer("sparse_send_streets", self._index_type, len(streets))
+        send_loads = self._buffer("sparse_send_loads", load_type, len(streets))
+        receive_streets = self._buffer("sparse_receive_streets", self._index_type, total_entries)
+        receive_loads = self._buffer("sparse_receive_loads", load_type, total_entries)
+        send_streets[:] = streets
+        send_loads[:] = local_traffic_load[streets]
+        index_type = MPI_TYPES[self._index_type]
+        mpi_type = MPI_TYPES[load_type]
+        self._requests = [self.communicator.Iallgatherv([send_streets, index_type], [receive_streets, (counts, offsets), index_type]),
+                          self.communicator.Iallgatherv([send_loads, mpi_type], [receive_loads, (counts, offsets), mpi_type])]
+        def finish():
+            # several processes may have traffic on the same street
+            as_numpy(self._total_traffic_load)[:] = numpy.bincount(receive_streets, weights = receive_loads, minlength = self.number_of_streets)
+        self._finish = finish
+
+
+    def _buffer(self, name, dtype, length):
+        # view of the first length elements of a buffer that only grows
+        buffer = self._buffers.get((name, dtype))
+        if buffer is None or len(buffer) < length:
+            buffer = numpy.empty(max(length, 1), dtype = dtype)
+            self._buffers[(name, dtype)] = buffer
+        return buffer[:length]
+
+
+def _narrowest_type(largest_value):
+    for dtype in (numpy.uint8, numpy.uint16):
+        if largest_value <= numpy.iinfo(dtype).max:
+            return dtype
+    return numpy.uint32
+
+
+if numpy is not None:
+    MPI_TYPES = { numpy.uint8 : MPI.UNSIGNED_CHAR, numpy.uint16 : MPI.UNSIGNED_SHORT, numpy.uint32 : MPI.UNSIGNED }
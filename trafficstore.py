@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# trafficstore.py
+# Copyright 2012 Julian Fietkau <http://www.julian-fietkau.de/>,
+#                Joachim Nitschke
+#
+# This file is part of Streets4MPI.
+#
+# Streets4MPI is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Streets4MPI is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import struct
+import mmap
+import zlib
+import bz2
+from array import array
+from os import path
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from utils import as_numpy
+
+# The traffic loads of all steps of a simulation in one file: a header with
+# the number of streets, followed by one record per simulated step. Every
+# record has a step header with the step number, the smallest and largest
+# traffic load of the step and how the traffic loads are compressed, then
+# the traffic load of every street as an unsigned 32 bit integer, starting
+# at a multiple of 8 bytes. Records are only ever appended, so the file can
+# be read while the simulation is running, and any step that is not
+# compressed can be read in place from a memory map.
+
+MAGIC = "S4MPITLS"
+VERSION = 2
+TRAFFIC_LOAD_FILENAME = "traffic_load.s4mpi"
+
+# magic, version, number of streets
+HEADER = struct.Struct("<8sIxxxxQ")
+# step, smallest and largest traffic load, codec, size of the traffic loads
+STEP_HEADER = struct.Struct("<IIIBxxxQ")
+
+# codecs by the number stored in the step header
+CODECS = ("none", "zlib", "bz2")
+
+def _aligned(size):
+    return (size + 7) & ~7
+
+def compress(data, codec, level = None):
+    # level None is the codec's default
+    if codec == "zlib":
+        return zlib.compress(data, 6 if level is None else level)
+    if codec == "bz2":
+        return bz2.compress(data, 9 if level is None else level)
+    return data
+
+def decompress(data, codec):
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "bz2":
+        return bz2.decompress(data)
+    return data
+
+# This class reads and appends the records of a traffic load file. Modes:
+# "r" - read an existing file
+# "w" - create a new file (an existing one is replaced)
+# "a" - append to an existing file, or create it
+# Appended records are compressed with the given codec ("none", "zlib" or
+# "bz2") and level.
+class TrafficLoadStore(object):
+
+    def __init__(self, filename, number_of_streets = None, mode = "r", codec = "none", level = None):
+        if mode not in ("r", "w", "a"):
+            raise ValueError("Unknown traffic load store mode: " + str(mode))
+        if codec not in CODECS:
+            raise ValueError("Unknown codec: " + str(codec))
+        self.filename = filename
+        self.mode = mode
+        self.codec = codec
+        self.level = level
+        # step -> (offset and size of the traffic loads, codec, smallest and
+        # largest traffic load), in step order
+        self._steps = []
+        self._records = dict()
+        self._file = None
+        self._map = None
+
+        if mode == "w" or (mode == "a" and not path.exists(filename)):
+            if number_of_streets is None:
+                raise ValueError("A new traffic load file needs the number of streets")
+            self.number_of_streets = number_of_streets
+            self._file = open(filename, "w+b")
+            self._file.write(HEADER.pack(MAGIC, VERSION, number_of_streets))
+            self._file.flush()
+            self._end = HEADER.size
+            return
+
+        store_file = open(filename, "rb" if mode == "r" else "r+b")
+        try:
+            magic, version, self.number_of_streets = HEADER.unpack(store_file.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("Not a traffic load file or unsupported version: " + filename)
+            if number_of_streets is not None and number_of_streets != self.number_of_streets:
+                raise ValueError("The traffic load file is for " + str(self.number_of_streets) + " streets, not " +
+                                 str(number_of_streets))
+            self._read_step_headers(store_file)
+        except:
+            store_file.close()
+            raise
+
+        if mode == "a":
+            self._file = store_file
+            # drop what is left of a record that was not written completely
+            self._file.truncate(self._end)
+        else:
+            # the map keeps a file descriptor of its own
+            if self._end > HEADER.size:
+                self._map = mmap.mmap(store_file.fileno(), self._end, access = mmap.ACCESS_READ)
+            store_file.close()
+
+
+    def _read_step_headers(self, store_file):
+        # only the step headers are read, the traffic loads stay on disk
+        store_file.seek(0, 2)
+        file_size = store_file.tell()
+        offset = HEADER.size
+        while offset + STEP_HEADER.size <= file_size:
+            store_file.seek(offset)
+            step, smallest, largest, codec, size = STEP_HEADER.unpack(store_file.read(STEP_HEADER.size))
+            if codec >= len(CODECS):
+                raise ValueError("Unknown codec in traffic load file: " + str(codec))
+            end = offset + STEP_HEADER.size + _aligned(size)
+            if end > file_size:
+                break
+            self._steps.append(step)
+            self._records[step] = (offset + STEP_HEADER.size, size, CODECS[codec], smallest, largest)
+            offset = end
+        self._end = offset
+
+
+    def steps(self):
+        return list(self._steps)
+
+
+    def __len__(self):
+        return len(self._steps)
+
+
+    def __contains__(self, step):
+        return step in self._records
+
+
+    def minimum(self, step):
+        return self._records[step][3]
+
+
+    def maximum(self, step = None):
+        # largest traffic load of the step, or of all steps
+        if step is None:
+            return max([record[4] for record in self._records.itervalues()] or [0])
+        return self._records[step][4]
+
+
+    def read(self, step):
+        # with NumPy, a read-only array that stays valid after close() (a
+        # view into the memory-mapped file if the step is not compressed),
+        # otherwise a copy in an array
+        if self._map is None:
+            raise ValueError("The traffic load file is not open for reading")
+        offset, size, codec = self._records[step][:3]
+        if numpy is not None and codec == "none":
+            return numpy.frombuffer(self._map, dtype = numpy.uint32, count = self.number_of_streets, offset = offset)
+        data = decompress(self._map[offset:offset + size], codec)
+        if numpy is not None:
+            return numpy.frombuffer(data, dtype = numpy.uint32)
+        traffic_load = array("I")
+        traffic_load.fromstring(data)
+        return traffic_load
+
+
+    def append(self, step, traffic_load):
+        # returns the number of bytes written
+        if self._file is None:
+            raise ValueError("The traffic load file is not open for writing")
+        if len(traffic_load) != self.number_of_streets:
+            raise ValueError("Expected the traffic load of " + str(self.number_of_streets) + " streets, not " +
+                             str(len(traffic_load)))
+        if len(self._steps) > 0 and step <= self._steps[-1]:
+            raise ValueError("Step " + str(step) + " is not after the last step " + str(self._steps[-1]))
+
+        if numpy is not None:
+            values = as_numpy(traffic_load).astype(numpy.uint32, copy = False)
+            data = values.tostring()
+            smallest, largest = (int(values.min()), int(values.max())) if len(values) > 0 else (0, 0)
+        else:
+            values = traffic_load if isinstance(traffic_load, array) and traffic_load.typecode == "I" else array("I", traffic_load)
+            data = values.tostring()
+            smallest, largest = (min(values), max(values)) if len(values) > 0 else (0, 0)
+
+        data = compress(data, self.codec, self.level)
+        size = len(data)
+        self._file.seek(self._end)
+        self._file.write(STEP_HEADER.pack(step, smallest, largest, CODECS.index(self.codec), size))
+        self._file.write(data)
+        self._file.write("\0" * (_aligned(size) - size))
+        self._file.flush()
+        self._steps.append(step)
+        self._records[step] = (self._end + STEP_HEADER.size, size, self.codec, smallest, largest)
+        record_size = STEP_HEADER.size + _aligned(size)
+        self._end += record_size
+        return record_size
+
+
+    def truncate(self, step):
+        # remove the records of all steps after the given one, e.g. those a
+        # run wrote after the checkpoint it is resumed from
+        if self._file is None:
+            raise ValueError("The traffic load file is not open for writing")
+        while len(self._steps) > 0 and self._steps[-1] > step:
+            self._end = self._records.pop(self._steps.pop())[0] - STEP_HEADER.size
+        self._file.truncate(self._end)
+
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        # views returned by read() keep the map alive until they are gone
+        self._map = None
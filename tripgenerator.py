@@ -21,38 +21,194 @@
 # along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from random import sample
+from array import array
+from bisect import bisect_left
+from random import Random
+from math import radians, cos, floor
 from time import time
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from utils import EARTH_RADIUS
+
+# This class holds the trips of all residents grouped by origin: the sorted
+# origins, and for each of them a slice of the goals and the number of
+# residents going to each goal. Looking up an origin returns a dict from its
+# goals to these numbers. All of these residents share one traffic jam
+# tolerance.
+class TripTable(object):
+
+    def __init__(self, origins, goal_offsets, goals, residents, jam_tolerance = 0.5):
+        self.origins = origins
+        self.goal_offsets = goal_offsets
+        self.goals = goals
+        self.residents = residents
+        self.jam_tolerance = jam_tolerance
+
+    def keys(self):
+        return self.origins.tolist()
+
+    def __len__(self):
+        return len(self.origins)
+
+    def __iter__(self):
+        return iter(self.origins)
+
+    def __contains__(self, origin):
+        position = bisect_left(self.origins, origin)
+        return position < len(self.origins) and self.origins[position] == origin
+
+    def __getitem__(self, origin):
+        position = bisect_left(self.origins, origin)
+        if position == len(self.origins) or self.origins[position] != origin:
+            raise KeyError(origin)
+        start, end = self.goal_offsets[position], self.goal_offsets[position + 1]
+        return dict(zip(self.goals[start:end], self.residents[start:end]))
+
+    def number_of_residents(self):
+        return sum(self.residents)
+
 # This class creates the appropriate number of residents and manages the trips
 class TripGenerator(object):
 
-    def generate_trips(self, number_of_residents, potential_origins, potential_goals):
-        trips = dict()
-        
-        for i in range(0, number_of_residents):
-            origin = sample(potential_origins, 1)[0]
-            goal = sample(potential_goals, 1)[0]
-
-            if origin in trips.keys():
-                goals = trips[origin]
-            else:
-                goals = list()
-            goals.append(goal)
-            trips[origin] = goals
+    def __init__(self, random_seed = None):
+        # trips only depend on the seed, not on the random module's state
+        self.random_seed = random_seed
+
+    # draws an origin and a goal for every resident and a traffic jam
+    # tolerance for all of them and returns the trips as a TripTable.
+    # origin_clusters optionally maps potential origins to the
+    # origin that all residents of its cluster start from, node_weights maps
+    # nodes to how much more likely they are drawn than others (default 1).
+    def generate_trips(self, number_of_residents, potential_origins, potential_goals, origin_clusters = None, node_weights = None):
+        # sorted, so that the trips do not depend on the order of the sets
+        potential_origins = sorted(potential_origins)
+        potential_goals = sorted(potential_goals)
+        if origin_clusters is None:
+            trip_origins = potential_origins
+        else:
+            trip_origins = [origin_clusters[origin] for origin in potential_origins]
+
+        origin_weights = goal_weights = None
+        if node_weights:
+            origin_weights = [node_weights.get(origin, 1) for origin in potential_origins]
+            goal_weights = [node_weights.get(goal, 1) for goal in potential_goals]
 
+        if numpy is not None:
+            trips = self._generate_trips_numpy(number_of_residents, trip_origins, potential_goals, origin_weights, goal_weights)
+        else:
+            trips = self._generate_trips_python(number_of_residents, trip_origins, potential_goals, origin_weights, goal_weights)
+        # like the trips, the tolerance only depends on the seed
+        trips.jam_tolerance = Random(self.random_seed).random()
         return trips
 
+    def _generate_trips_numpy(self, number_of_residents, trip_origins, potential_goals, origin_weights, goal_weights):
+        if number_of_residents == 0:
+            # the grouping below needs at least one trip
+            return TripTable(array("l"), array("l", [0]), array("l"), array("I"))
+        generator = numpy.random.RandomState(self.random_seed)
+        def draw(candidates, weights):
+            if weights is None:
+                return generator.randint(0, len(candidates), number_of_residents)
+            weights = numpy.asarray(weights, dtype = numpy.float64)
+            return generator.choice(len(candidates), number_of_residents, p = weights / weights.sum())
+        origins = numpy.asarray(trip_origins, dtype = numpy.int64)[draw(trip_origins, origin_weights)]
+        goals = numpy.asarray(potential_goals, dtype = numpy.int64)[draw(potential_goals, goal_weights)]
+
+        # group by origin and goal and count the residents of every pair
+        order = numpy.lexsort((goals, origins))
+        origins = origins[order]
+        goals = goals[order]
+        pair_starts = numpy.flatnonzero(numpy.concatenate(([True], (origins[1:] != origins[:-1]) | (goals[1:] != goals[:-1]))))
+        residents = numpy.diff(numpy.append(pair_starts, len(origins)))
+        origins = origins[pair_starts]
+        goals = goals[pair_starts]
+        origin_starts = numpy.flatnonzero(numpy.concatenate(([True], origins[1:] != origins[:-1])))
+
+        return TripTable(array("l", origins[origin_starts].tostring()),
+                         array("l", numpy.append(origin_starts, len(goals)).astype(numpy.int64).tostring()),
+                         array("l", goals.tostring()),
+                         array("I", residents.astype(numpy.uint32).tostring()))
+
+    def _generate_trips_python(self, number_of_residents, trip_origins, potential_goals, origin_weights, goal_weights):
+        generator = Random(self.random_seed)
+        def draw(candidates, weights):
+            if weights is None:
+                return [candidates[int(generator.random() * len(candidates))] for i in xrange(number_of_residents)]
+            cumulative_weights = []
+            total = 0
+            for weight in weights:
+                total += weight
+                cumulative_weights.append(total)
+            return [candidates[min(bisect_left(cumulative_weights, generator.random() * total), len(candidates) - 1)]
+                    for i in xrange(number_of_residents)]
+
+        trips = dict()
+        for origin, goal in zip(draw(trip_origins, origin_weights), draw(potential_goals, goal_weights)):
+            goals = trips.get(origin)
+            if goals is None:
+                goals = trips[origin] = dict()
+            goals[goal] = goals.get(goal, 0) + 1
+
+        origins = array("l", sorted(trips))
+        goal_offsets = array("l", [0])
+        goals = array("l")
+        residents = array("I")
+        for origin in origins:
+            for goal, number in sorted(trips[origin].iteritems()):
+                goals.append(goal)
+                residents.append(number)
+            goal_offsets.append(len(goals))
+        return TripTable(origins, goal_offsets, goals, residents)
+
+# This function returns how likely each node is drawn as origin or goal,
+# relative to nodes outside of any landuse area. weights maps "residential",
+# "commercial" and "industrial" to a weight; nodes in several areas get the
+# largest weight.
+def landuse_node_weights(weights, residential_nodes, commercial_nodes, industrial_nodes):
+    node_weights = dict()
+    for area_type, nodes in (("residential", residential_nodes), ("commercial", commercial_nodes), ("industrial", industrial_nodes)):
+        weight = weights.get(area_type, 1)
+        for node in nodes:
+            node_weights[node] = max(node_weights.get(node, weight), weight)
+    return node_weights
+
+# This function divides the potential origins into square grid cells of the
+# given size (in m) and maps each of them to the origin closest to the
+# centroid of its cell's origins (not to the center of the cell, which may
+# lie far from any street), so that the number of shortest path trees per
+# step is bounded by the number of cells instead of the number of residents
+def cluster_origins(street_network, potential_origins, cell_size):
+    cells = dict()
+    for origin in potential_origins:
+        longitude, latitude = street_network.node_coordinates(origin)
+        # simple equirectangular projection, good enough for grid cells
+        x = radians(longitude) * EARTH_RADIUS * cos(radians(latitude))
+        y = radians(latitude) * EARTH_RADIUS
+        cells.setdefault((int(floor(x / cell_size)), int(floor(y / cell_size))), []).append((origin, x, y))
+
+    origin_clusters = dict()
+    for cell_origins in cells.itervalues():
+        centroid_x = sum(x for origin, x, y in cell_origins) / len(cell_origins)
+        centroid_y = sum(y for origin, x, y in cell_origins) / len(cell_origins)
+        representative = min(cell_origins, key = lambda entry: ((entry[1] - centroid_x) ** 2 + (entry[2] - centroid_y) ** 2, entry[0]))[0]
+        for origin, x, y in cell_origins:
+            origin_clusters[origin] = representative
+
+    return origin_clusters
+
 if __name__ == "__main__":
-    manager = TripManager(30, set([1, 2, 3, 4, 5]), set([6, 7, 8, 9, 10]))
+    generator = TripGenerator(42)
 
     start = time()
 
-    manager.create_trips()
+    trips = generator.generate_trips(1000000, xrange(100000), xrange(100000, 110000))
 
     generated = time()
 
     # done
-    print "Trips: ", manager.trips
+    print "Trips: ", len(trips), "origins for", trips.number_of_residents(), "residents"
     print "Time generating trips: ", generated - start, " seconds"
-
@@ -21,15 +21,61 @@
 #
 
 from array import array
-from itertools import repeat
+from math import sqrt, radians, sin, cos, asin
 
-def merge_arrays(arrays):
-    merged_array = array("I", repeat(0, len(arrays[0])))
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-    for arr in arrays:
-        if arr != None:
-            for index in range(0, len(arr)):
-                merged_array[index] += arr[index]
+EARTH_RADIUS = 6367000 # m
 
-    return merged_array
+# numpy types matching the type codes of the arrays we use
+if numpy is not None:
+    NUMPY_TYPES = { "d" : numpy.float64, "f" : numpy.float32, "i" : numpy.int32, "I" : numpy.uint32, "l" : numpy.int64, "B" : numpy.uint8, "H" : numpy.uint16 }
 
+def add_array(target, values):
+    # add values to an array.array of the same length in place
+    if numpy is not None:
+        as_numpy(target)[:] += as_numpy(values)
+    else:
+        for index in xrange(len(target)):
+            target[index] += values[index]
+
+
+def as_numpy(values):
+    # numpy view sharing the memory of an array.array (only valid as long as
+    # the array is not resized), other sequences are converted
+    if isinstance(values, array):
+        return numpy.frombuffer(values, dtype = NUMPY_TYPES[values.typecode])
+    return numpy.asarray(values)
+
+def assign_array(target, values):
+    # overwrite all elements of an array.array in place with values from a
+    # list, an array or a numpy array of the same length
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        as_numpy(target)[:] = values
+    else:
+        target[:] = array(target.typecode, values)
+
+def haversine(longitude1, latitude1, longitude2, latitude2):
+    # calculate distance using the haversine formula, which incorporates
+    # earth curvature
+    # see http://en.wikipedia.org/wiki/Haversine_formula
+    latitude1, longitude1, latitude2, longitude2 = map(radians, [latitude1, longitude1, latitude2, longitude2])
+    dlon = longitude2 - longitude1
+    dlat = latitude2 - latitude1
+    a = sin(dlat/2)**2 + cos(latitude1) * cos(latitude2) * sin(dlon/2)**2
+    c = 2 * asin(sqrt(a))
+    return EARTH_RADIUS * c # return distance in m
+
+def haversines(longitudes1, latitudes1, longitudes2, latitudes2):
+    # haversine formula for numpy arrays of coordinates; numpy's sin, cos
+    # and arcsin round differently from the math module, so the results only
+    # equal those of haversine to within floating-point rounding
+    latitudes1, longitudes1, latitudes2, longitudes2 = map(numpy.radians, [latitudes1, longitudes1, latitudes2, longitudes2])
+    dlon = longitudes2 - longitudes1
+    dlat = latitudes2 - latitudes1
+    a = numpy.sin(dlat/2)**2 + numpy.cos(latitudes1) * numpy.cos(latitudes2) * numpy.sin(dlon/2)**2
+    c = 2 * numpy.arcsin(numpy.sqrt(a))
+    return EARTH_RADIUS * c # distances in m
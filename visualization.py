@@ -21,23 +21,24 @@
 # along with Streets4MPI.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import re
-from os import listdir
 from PIL import Image, ImageChops, ImageDraw, ImageFont
 from math import floor
 from datetime import datetime
+from os import path
 
-from pygraph.algorithms.accessibility import connected_components
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from streetnetwork import StreetNetwork
-from persistence import persist_read
+from trafficstore import TrafficLoadStore, TRAFFIC_LOAD_FILENAME
+from networkio import read_network_snapshot, apply_max_speed_change, SNAPSHOT_FILENAME
 from simulation import calculate_driving_speed
 
 # This class turns persistent traffic load data into images
 class Visualization(object):
 
-    ATTRIBUTE_KEY_COMPONENT = 2
-
     # Modes:
     # COMPONENTS   - display connected components
     # TRAFFIC_LOAD - display absolute traffic load
@@ -49,7 +50,7 @@ class Visualization(object):
     # HEATMAP      - vary hue on a temperature-inspired scale from dark blue to red
     # MONOCHROME   - vary brightness from black to white
 
-    def __init__(self, street_network_filename_pattern, traffic_load_filename_pattern, mode = 'TRAFFIC_LOAD', color_mode = 'HEATMAP'):
+    def __init__(self, street_network_filename = SNAPSHOT_FILENAME, traffic_load_filename = TRAFFIC_LOAD_FILENAME, mode = 'TRAFFIC_LOAD', color_mode = 'HEATMAP'):
         print "Welcome to Streets4MPI visualization!"
         print "Current display mode:", mode, "with color mode", color_mode
 
@@ -59,54 +60,53 @@ class Visualization(object):
         self.bounds = None
         self.street_network = None
         self.node_coords = dict()
+        self.components = None
         self.mode = mode
         self.color_mode = color_mode
-        self.street_network_filename_expression = re.compile(street_network_filename_pattern)
-        self.traffic_load_filename_expression = re.compile(traffic_load_filename_pattern)
+        self.street_network_filename = street_network_filename
+        self.traffic_load_filename = traffic_load_filename
 
     def visualize(self):
-        # find files
-        all_files = listdir('.')
-        street_network_files = filter(self.street_network_filename_expression.search, all_files)
-        traffic_load_files = filter(self.traffic_load_filename_expression.search, all_files)
-
-        # keep max traffic load to setup legend later
-        max_load = 0
-
-        # find max traffic load
-        for traffic_load_file in traffic_load_files:
-            traffic_load = persist_read(traffic_load_file, is_array = True)
-            max_load = max(max_load, max(traffic_load))
-
-        step = 0
-        while len(traffic_load_files) > 0:
-            step += 1
+        # nothing to draw if the simulation did not persist its traffic load
+        if not path.exists(self.traffic_load_filename):
+            print "No traffic load data found in", self.traffic_load_filename
+            print "Done!"
+            return
+
+        # only the parts of the street network that are used are read from
+        # disk, later changes of max speeds are applied at their step
+        print "Reading street network..."
+        self.street_network, changes = read_network_snapshot(self.street_network_filename, share_topology = numpy is not None)
+        changes = dict((step, (changed_streets, max_speeds)) for step, changed_streets, max_speeds in changes)
+        self.bounds = self.street_network.bounds
+        self.zoom = self.max_resolution[0] / max((self.bounds[0][1] - self.bounds[0][0]) * self.coord2km[0],
+                          (self.bounds[1][1] - self.bounds[1][0]) * self.coord2km[1])
+
+        for node in self.street_network.get_nodes():
+            self.node_coords[node] = self.project(self.street_network.node_coordinates(node))
+
+        if self.mode == 'COMPONENTS':
+              self.components = self.street_network.connected_components()
+
+        traffic_load_store = TrafficLoadStore(self.traffic_load_filename)
+
+        # the largest traffic load of every step is stored with it, the max
+        # of all steps is needed to setup the legend
+        max_load = traffic_load_store.maximum()
+
+        steps = traffic_load_store.steps()
+        for step in xrange(1, steps[-1] + 1 if steps else 1):
             print "Step counter", step
 
-            # check if there is a street network for the current step and load it
-            street_network_filename = "street_network_" + str(step) + ".s4mpi"
-            if street_network_filename in street_network_files:
-                print "  Found street network data, reading..."
-                self.street_network = persist_read(street_network_filename)
-                self.bounds = self.street_network.bounds
-                self.zoom = self.max_resolution[0] / max((self.bounds[0][1] - self.bounds[0][0]) * self.coord2km[0],
-                                  (self.bounds[1][1] - self.bounds[1][0]) * self.coord2km[1])
-
-                for node in self.street_network.get_nodes():
-                    coords = self.street_network.node_coordinates(node)
-                    point = dict()
-                    for i in range(2):
-                        point[i] = (coords[1-i] - self.bounds[i][0]) * self.coord2km[i] * self.zoom
-                    self.node_coords[node] = (point[1], self.max_resolution[1] - point[0]) # x = longitude, y = latitude
-
-                if self.mode == 'COMPONENTS':
-                      self.calculate_components(self.street_network._graph)
+            # check if the max speeds changed for the current step
+            if step in changes:
+                print "  Found max speed changes, applying..."
+                apply_max_speed_change(self.street_network, *changes[step])
 
             # check if there is traffic load for the current step and draw it
-            traffic_load_filename = "traffic_load_" + str(step) + ".s4mpi"
-            if traffic_load_filename in traffic_load_files:
+            if step in traffic_load_store:
                 print "  Found traffic load data, reading and drawing..."
-                traffic_load = persist_read(traffic_load_filename, is_array = True)
+                traffic_load = traffic_load_store.read(step)
                 street_network_image = Image.new("RGBA", self.max_resolution, (0, 0, 0, 255))
                 draw = ImageDraw.Draw(street_network_image)
 
@@ -128,22 +128,27 @@ class Visualization(object):
                         value = min(1.0, 1.0 * actual_speed / 140)
                     color = self.value_to_color(value)
                     if self.mode == 'COMPONENTS':
-                        component = dict(self.street_network._graph.edge_attributes(street))[Visualization.ATTRIBUTE_KEY_COMPONENT]
+                        component = max(self.components[street[0]], self.components[street[1]])
                         color = "hsl(" + str(int(137.5*component) % 360) + ",100%,50%)"
-                    draw.line([self.node_coords[street[0]], self.node_coords[street[1]]], fill=color, width=width)
+                    # simplified streets are drawn along the nodes they replace
+                    points = [self.node_coords[street[0]]]
+                    points.extend(self.project(coords) for coords in self.street_network.get_street_geometry(street_index))
+                    points.append(self.node_coords[street[1]])
+                    draw.line(points, fill=color, width=width)
 
                 street_network_image = self.image_finalize(street_network_image, max_load)
                 print "  Saving image to disk (traffic_load_" + str(step) + ".png) ..."
                 street_network_image.save("traffic_load_" + str(step) + ".png")
 
-                traffic_load_files.remove(traffic_load_filename)
-
+        traffic_load_store.close()
         print "Done!"
 
-    def calculate_components(self, graph):
-        components = connected_components(graph)
-        for edge in graph.edges():
-            graph.add_edge_attribute(edge, (Visualization.ATTRIBUTE_KEY_COMPONENT, max(components[edge[0]], components[edge[1]])))
+    def project(self, coords):
+        # image position of a (longitude, latitude) pair
+        point = dict()
+        for i in range(2):
+            point[i] = (coords[1-i] - self.bounds[i][0]) * self.coord2km[i] * self.zoom
+        return (point[1], self.max_resolution[1] - point[0]) # x = longitude, y = latitude
 
     def find_max_value(self, dictionary):
         max_value = 0
@@ -224,6 +229,6 @@ class Visualization(object):
         return image.crop(bbox)        
 
 if __name__ == "__main__":
-    visualization = Visualization("^street_network_[0-9]+.s4mpi$", "^traffic_load_[0-9]+.s4mpi$", mode='TRAFFIC_LOAD')
+    visualization = Visualization(SNAPSHOT_FILENAME, TRAFFIC_LOAD_FILENAME, mode='TRAFFIC_LOAD')
     visualization.visualize()
 